@@ -0,0 +1,117 @@
+"""
+LJ-specific rewrites of post and comment bodies, compiled once and applied in a single scan.
+
+transform() turns a raw body into a Body holding three versions:
+
+    text        user links replaced by usernames, otherwise as downloaded (for JSON, search and slugs)
+    html        also with lj-cut/lj-embed tags rewritten and bare newlines as <br>, for the HTML output
+                and comments
+    md_html     the same for html2text, for the Markdown output: bare newlines become a plain <br>,
+                since html2text renders a newline after one as a space in places such as blockquotes
+
+clean_markdown() does the same for html2text's output: collapses runs of blank lines and takes the
+UTX tag images out, returning the tags it found.
+"""
+
+import re
+
+
+class Transformer:
+    """
+    A set of regex rules compiled into one alternation, so a text is scanned once whatever the number of rules.
+
+    Each rule is (name, pattern, replacement).  The replacement is a tuple of strings, one per output,
+    or a function taking (match, found) and returning such a tuple; found is a list the rule may add
+    things to, such as tags.  Patterns can use named groups of their own, prefixed with the rule name.
+    Where rules could match at the same place, the first one listed wins.
+    """
+
+    def __init__(self, rules, outputs=1):
+        self.outputs = outputs
+        self.pattern = re.compile('|'.join(f'(?P<{name}>{pattern})' for name, pattern, _ in rules))
+        self.replacements = {name: replacement for name, _, replacement in rules}
+
+    def apply(self, text, found=None):
+        """ A tuple with one transformed copy of text per output """
+        parts = [[] for _ in range(self.outputs)]
+        pos = 0
+
+        for m in self.pattern.finditer(text):
+            start = m.start()
+            if start > pos:
+                for p in parts:
+                    p.append(text[pos:start])
+
+            replacement = self.replacements[m.lastgroup]
+            if callable(replacement):
+                replacement = replacement(m, found)
+
+            for p, r in zip(parts, replacement):
+                p.append(r)
+
+            pos = m.end()
+
+        if not pos:
+            return (text,) * self.outputs
+
+        for p in parts:
+            p.append(text[pos:])
+
+        return tuple(''.join(p) for p in parts)
+
+
+class Body:
+    __slots__ = ('text', 'html', 'md_html')
+
+    def __init__(self, text, html, md_html):
+        self.text = text
+        self.html = html
+        self.md_html = md_html
+
+
+def user_link(m, found):
+    # A newline straight after the link was after a '>', so it stays a plain newline
+    name = m.group('user_name')
+    newline = m.group('user_newline') or ''
+    return name + newline, name + (newline and '<br>\n'), name + (newline and '<br>')
+
+
+def embed(m, found):
+    div = '<div class=lj-embed data-embed="{0}"></div>'.format(m.group('embed_id'))
+    return m.group(0), div, div
+
+
+def utx_tag(m, found):
+    if found is not None:
+        found.append(m.group('utx_tag_name'))
+    return ('',)
+
+
+BODY_RULES = Transformer([
+    ('user', r'<lj user="?(?P<user_name>.*?)"?>(?P<user_newline>\n)?', user_link),
+    # The cut itself isn't kept: every page shows the whole post
+    ('cut', r'</?lj-cut\b[^>]*>', lambda m, found: (m.group(0), '', '')),
+    # Embeds come as placeholders (the player isn't in the export), or wrapped around their content
+    ('embed', r'<lj-embed\b[^>]*?\bid="?(?P<embed_id>\d+)"?[^>]*?/>', embed),
+    ('embed_wrapper', r'</?lj-embed\b[^>]*>', lambda m, found: (m.group(0), '', '')),
+    ('newline', r'(?<!>)\n', ('\n', '<br>\n', '<br>')),
+], outputs=3)
+
+MARKDOWN_RULES = Transformer([
+    ('blank_lines', r'(?:\s*\n){3,}', ('\n\n',)),
+    ('utx_tag', r'\[!\[(?P<utx_tag_name>.*?)\]\(http://utx\.ambience\.ru/img/.*?\)\]\(.*?\)', utx_tag),
+])
+
+
+def transform(text):
+    if not text:
+        return Body(text, text, text)
+
+    return Body(*BODY_RULES.apply(text))
+
+
+def clean_markdown(md):
+    """ (markdown with blank line runs collapsed and UTX tags removed, [tags]) """
+    tags = []
+    md, = MARKDOWN_RULES.apply(md, tags)
+    return md, tags
@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import export
+import ljconfig as config
+import progress
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    if getattr(config, 'show_progress', True):
+        progress.add_listener(progress.TerminalRenderer())
+
+    journals = getattr(config, 'journals', None) or [config.username]
+    summaries = export_journals(journals, max_workers=getattr(config, 'bulk_max_workers', 4))
+
+    print_summaries(summaries)
+
+    if any(s['status'] != 'ok' for s in summaries):
+        sys.exit(1)
+
+
+def export_journals(journals, max_workers=4, top_dir=export.DOWNLOADED_JOURNALS_DIR):
+    """
+    Exports several journals concurrently.  Requests to LJ share ratelimit.LJ_RATE_LIMIT, the
+    userpic/FOAF cache is the process-wide one in userpics, and commenter ids are resolved
+    through a single usermap.
+    """
+    users_map = {}
+    summaries = []
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='export') as pool:
+        futures = {
+            pool.submit(export.export_journal, journal, top_dir=top_dir, users_map=users_map, slugs={}): journal
+            for journal in dict.fromkeys(journals)
+        }
+
+        for future in as_completed(futures):
+            journal = futures[future]
+            try:
+                summary = future.result()
+            except Exception as e:
+                log.exception(f"Export of {journal} failed")
+                summary = {'journal': journal, 'status': 'error', 'reason': str(e), 'posts': 0, 'comments': 0}
+
+            log.info(f"Finished {journal}: {summary['status']}")
+            summaries.append(summary)
+
+    # Report in the order the journals were asked for
+    order = {journal: i for i, journal in enumerate(journals)}
+    return sorted(summaries, key=lambda s: order[s['journal']])
+
+
+def print_summaries(summaries):
+    print(f"{'journal':<24} {'status':<8} {'posts':>8} {'comments':>10} {'time':>9}")
+    for s in summaries:
+        elapsed = s.get('elapsed')
+        elapsed_str = f"{elapsed:8.1f}s" if elapsed is not None else '        -'
+        print(f"{s['journal']:<24} {s['status']:<8} {s['posts']:>8} {s['comments']:>10} {elapsed_str}")
+        if s.get('reason'):
+            print(f"    {s['reason']}")
+
+
+if __name__ == '__main__':
+    export.setup_logging()
+
+    main()
@@ -0,0 +1,229 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Compact in-memory representation of comments.
+
+A journal can have a million comments, and a dict per comment (plus a children list) costs far
+more than the data it holds.  Comment uses __slots__ and interns the strings that repeat a lot
+(author names, states); CommentThread keeps a post's reply structure as flat child-index arrays
+instead of nested lists of objects.
+
+Run this file with the path to an all_comments.json to compare memory use against plain dicts.
+"""
+
+import json
+import sys
+import tracemalloc
+from array import array
+
+
+class Comment:
+    __slots__ = ('id', 'jitemid', 'parentid', 'posterid', 'date', 'epoch', 'subject', 'body', 'state', 'author')
+
+    def __init__(self, id, jitemid, parentid=None, posterid=None, date=None, subject=None, body=None,
+                 state=None, author=None, epoch=None):
+        self.id = id
+        self.jitemid = jitemid
+        self.parentid = parentid
+        self.posterid = posterid
+        self.date = date
+        self.epoch = epoch
+        self.subject = subject
+        self.body = body
+        self.state = state and sys.intern(state)
+        self.author = author and sys.intern(author)
+
+    def __repr__(self):
+        return f'<Comment {self.id} on {self.jitemid} by {self.author}>'
+
+    @property
+    def deleted(self):
+        return self.state == 'D'
+
+    def to_dict(self):
+        """ The comment in the dict layout used by all_comments.json and the per-post JSON files """
+        rv = {'jitemid': self.jitemid, 'id': self.id, 'children': []}
+        for name in self.__slots__[2:]:
+            value = getattr(self, name)
+            if value is not None:
+                rv[name] = value
+
+        return rv
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**{name: d[name] for name in cls.__slots__ if name in d})
+
+
+class CommentThread:
+    """
+    The comments of one post, sorted by id, with replies stored as child-index arrays.
+
+    The children of comments[i] are comments[child_index[child_start[i]:child_start[i + 1]]],
+    in id order.  roots holds the indices of top-level comments, including replies whose parent
+    isn't in the export (deleted or screened), so they are shown rather than lost.
+
+    Nothing here recurses, so threads of any depth are fine.
+    """
+    __slots__ = ('comments', 'roots', 'child_start', 'child_index')
+
+    def __init__(self, comments):
+        self.comments = sorted(comments, key=lambda c: c.id)
+
+        index_of = {c.id: i for i, c in enumerate(self.comments)}
+        parents = array('l', (index_of.get(c.parentid, -1) for c in self.comments))
+
+        self.roots = array('l', (i for i, p in enumerate(parents) if p < 0))
+
+        # Count children per comment, turn counts into offsets, then fill.  Filling in id order keeps
+        # each comment's children sorted without any further sorting.
+        n = len(self.comments)
+        self.child_start = array('l', [0]) * (n + 1)
+        for p in parents:
+            if p >= 0:
+                self.child_start[p + 1] += 1
+        for i in range(n):
+            self.child_start[i + 1] += self.child_start[i]
+
+        fill = array('l', self.child_start)
+        self.child_index = array('l', [0]) * self.child_start[n]
+        for i, p in enumerate(parents):
+            if p >= 0:
+                self.child_index[fill[p]] = i
+                fill[p] += 1
+
+    def __len__(self):
+        return len(self.comments)
+
+    def children(self, i):
+        return self.child_index[self.child_start[i]:self.child_start[i + 1]]
+
+    def walk(self, skip=None):
+        """
+        Depth-first traversal in display order, using an explicit stack.
+
+        Yields (index, level, entering): once with entering=True before a comment's replies and once
+        with entering=False after them.  Comments for which skip(comment) is true are left out along
+        with all their replies.
+        """
+        stack = [(i, 0, True) for i in reversed(self.roots)]
+
+        while stack:
+            i, level, entering = stack.pop()
+
+            if not entering:
+                yield i, level, False
+                continue
+
+            if skip is not None and skip(self.comments[i]):
+                continue
+
+            yield i, level, True
+            stack.append((i, level, False))
+            stack.extend((c, level + 1, True) for c in reversed(self.children(i)))
+
+    def to_nested(self):
+        """ The thread as nested comment dicts, the layout written to the per-post JSON files """
+        nested = [c.to_dict() for c in self.comments]
+        for i, d in enumerate(nested):
+            d['children'] = [nested[c] for c in self.children(i)]
+
+        return [nested[i] for i in self.roots]
+
+    def to_nested_json(self, indent=None, level=0):
+        """
+        to_nested() as JSON text, the same as json.dumps(self.to_nested(), ensure_ascii=False, indent=indent)
+        at nesting depth `level` of an enclosing document.  json.dumps recurses and fails a few hundred
+        replies deep, so the nesting is written here from walk() and only flat comment dicts are dumped.
+        """
+        return ''.join(self.iter_nested_json(indent=indent, level=level))
+
+    def iter_nested_json(self, indent=None, level=0):
+        """ to_nested_json() in pieces, a comment at a time """
+        def newline(depth):
+            return indent is not None and '\n' + ' ' * (indent * depth) or ''
+
+        item_sep = indent is not None and ',' or ', '
+
+        if not len(self.roots):
+            yield '[]'
+            return
+
+        # A placeholder for 'children', which to_dict puts ahead of the text fields, so the first
+        # occurrence of it in a dumped comment is always the real one
+        placeholder = '\x00children\x00'
+        placeholder_json = json.dumps(placeholder)
+
+        yield '['
+        siblings = [0]
+        tails = []
+
+        for i, depth, entering in self.walk():
+            # Comments at walk depth d are dicts at JSON depth level + 1 + 2d: each reply list adds two
+            dict_level = level + 1 + 2 * depth
+            has_children = len(self.children(i)) > 0
+
+            if entering:
+                opening = (siblings[-1] and item_sep or '') + newline(dict_level)
+                siblings[-1] += 1
+                siblings.append(0)
+
+                d = self.comments[i].to_dict()
+                d['children'] = placeholder
+                text = json.dumps(d, ensure_ascii=False, indent=indent).replace('\n', newline(dict_level))
+                head, tail = text.split(placeholder_json, 1)
+
+                yield opening + head + (has_children and '[' or '[]')
+                tails.append(tail)
+            else:
+                siblings.pop()
+                yield (has_children and newline(dict_level + 1) + ']' or '') + tails.pop()
+
+        yield newline(level) + ']'
+
+
+def group_by_post(comments):
+    posts = {}
+
+    for comment in comments:
+        posts.setdefault(comment.jitemid, []).append(comment)
+
+    return posts
+
+
+def benchmark_memory(comment_dicts):
+    """ Memory held by comment_dicts as the old per-post dicts of dicts vs Comment objects and threads """
+    def measure(build):
+        tracemalloc.start()
+        held = build()
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del held
+        return current
+
+    def as_dicts():
+        by_post = {}
+        for d in json.loads(raw):
+            d['children'] = []
+            by_post.setdefault(d['jitemid'], {})[d['id']] = d
+        return by_post
+
+    def as_comments():
+        return [CommentThread(c) for c in group_by_post(Comment.from_dict(d) for d in json.loads(raw)).values()]
+
+    raw = json.dumps(comment_dicts)
+    return {
+        'comments': len(comment_dicts),
+        'dict_bytes': measure(as_dicts),
+        'compact_bytes': measure(as_comments),
+    }
+
+
+if __name__ == '__main__':
+    with open(sys.argv[1]) as f:
+        result = benchmark_memory(json.load(f))
+
+    print(f"{result['comments']} comments")
+    print(f"  dicts:   {result['dict_bytes'] / 2 ** 20:10.1f} MiB")
+    print(f"  compact: {result['compact_bytes'] / 2 ** 20:10.1f} MiB")
@@ -7,22 +7,36 @@ import logging
 import os
 import re
 import sys
+import threading
 import time
 import xml.etree.ElementTree as xml_element_tree
-from datetime import datetime
+from collections import ChainMap, Counter
 from hashlib import md5
-from operator import itemgetter
+from itertools import chain
 from pathlib import Path
+from urllib.parse import unquote_plus
 from lxml import etree
 
-import arrow
 import html2text
 import markdown
 import requests
-from jitter import jitter
+from jitter import delay
 
+import analytics
+import bodytext
+import jsonstream
 import ljconfig as config
+import media
+import outwriter
+import pages
+import picassets
+import progress
+import rawstore
+import search
+import timestamps
+from comments import Comment, CommentThread, group_by_post
 import userpics
+from ratelimit import LJ_RATE_LIMIT
 
 # Other constants
 HEADERS = {
@@ -40,6 +54,12 @@ DOWNLOADED_JOURNALS_DIR = "exported_journals"
 # defines the relative location for locating userpics in comments, no leading or trailing /
 STATIC_USERPIC_PART = 'static/userpics'
 
+# same, for images from post and comment bodies archived into the media directory
+STATIC_MEDIA_PART = 'static/media'
+
+# same, for the resized userpics and sprite sheets in the userpic_assets directory
+STATIC_USERPIC_ASSETS_PART = 'static/userpic_assets'
+
 # A list of directories created under the /exported_journals/username/ directory
 EXPORT_DIRS = [
     'posts_xml',
@@ -47,50 +67,147 @@ EXPORT_DIRS = [
     'posts_html',
     'posts_markdown',
     'comments_xml',
-    'userpics'
+    'userpics',
+    'userpic_assets',
+    'media'
 ]
 
-TAG = re.compile(r'\[!\[(.*?)\]\(http:/\/utx.ambience.ru\/img\/.*?\)\]\(.*?\)')
-USER = re.compile(r'<lj user="?(.*?)"?>')
-TAGLESS_NEWLINES = re.compile('(?<!>)\n')
-NEWLINES = re.compile('(\s*\n){3,}')
+# For slugs: everything not in [a-zA-Z0-9], a leading or trailing -, and runs of -
+SLUG_NOT_WORDS = re.compile(r'\W+|_')
+SLUG_EDGE_DASH = re.compile(r'^-|-$')
+SLUG_DASHES = re.compile(r'-+')
 SLUGS = {}
 
-global log
+# None to store raw XML downloads as-is, or 'gzip'/'zstd' to store them compressed
+RAW_COMPRESSION = getattr(config, 'raw_compression', None)
+
+# all_posts/all_comments as a 'json' array or as 'jsonl' (one record per line); indent None for compact JSON
+JSON_FORMAT = getattr(config, 'json_format', 'json')
+JSON_INDENT = getattr(config, 'json_indent', 2)
+
+# Full-text search index built during combine, optionally also as static JSON shards for the generated site
+SEARCH_INDEX = getattr(config, 'search_index', True)
+SEARCH_SHARDS = getattr(config, 'search_shards', False)
+
+# Background threads writing output files while combine renders; 0 writes them inline
+OUTPUT_THREADS = getattr(config, 'output_threads', 4)
+
+# None writes one file per post and format; 'zip', 'tar', 'tar.gz', 'tar.bz2' or 'tar.xz' streams
+# everything into exported_journals/<username>/export.<format> instead
+OUTPUT_ARCHIVE = getattr(config, 'output_archive', None)
+
+# None to link comments to the downloaded userpics, or 'webp'/'png' for copies resized to 100x100,
+# optionally packed into sprite sheets of up to USERPIC_SPRITE_SIZE pics (needs Pillow)
+USERPIC_ASSETS = getattr(config, 'userpic_assets', None)
+USERPIC_SPRITES = getattr(config, 'userpic_sprites', False)
+USERPIC_SPRITE_SIZE = getattr(config, 'userpic_sprite_size', 256)
+
+# Where download_posts gets posts: 'export' (export_do.bml, one request per month) or 'flat' (the
+# flat protocol: syncitems lists the entries that exist or changed, getevents fetches them in batches)
+POST_BACKEND = getattr(config, 'post_backend', 'export')
+FLAT_BATCH_SIZE = getattr(config, 'flat_batch_size', 50)
+FLAT_BATCH_BYTES = getattr(config, 'flat_batch_bytes', 1000000)
+FLAT_SYNC_FILE = 'flat_sync.json'
+
+# The <entry> fields post_xml_to_json reads, in export_do.bml's order
+ENTRY_FIELDS = ['itemid', 'eventtime', 'logtime', 'subject', 'event', 'security', 'allowmask', 'current_music',
+                'current_mood']
+
+# Control characters XML can't hold, which do turn up in old posts
+XML_INVALID_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+log = logging.getLogger(__name__)
 
 
 def main():
+    if getattr(config, 'show_progress', True):
+        progress.add_listener(progress.TerminalRenderer())
+
+    summary = export_journal(config.username)
+
+    if summary['status'] != 'ok':
+        log.critical(f"Something went wrong: {summary.get('reason', '(unknown reason)')}")
+        sys.exit(1)
+
+
+def export_journal(journal, top_dir=DOWNLOADED_JOURNALS_DIR, users_map=None, slugs=None):
+    """
+    Runs the full export for one journal or community, and returns a summary dict.
+
+    users_map is an optional commenter id -> username dict shared between journals, and
+    slugs an optional per-journal slug registry (bulk exports pass a fresh one per journal).
+    """
+    summary = {
+        'journal': journal,
+        'status': 'ok',
+        'posts': 0,
+        'comments': 0
+    }
+    start_time = time.monotonic()
+
     # Setup export directories for this LJ user
-    export_dirs = ensure_export_dirs(DOWNLOADED_JOURNALS_DIR, config.username, EXPORT_DIRS)
+    export_dirs = ensure_export_dirs(top_dir, journal, EXPORT_DIRS)
 
     # Get userpics for lj_user's friends
     if True:
-        log.info("Getting friends pics")
-        get_friend_pics = userpics.get_friends_default_pics_for_user(config.username, copy_dir=export_dirs['userpics'])
+        log.info(f"Getting friends pics for {journal}")
+        get_friend_pics = userpics.get_friends_default_pics_for_user(journal, copy_dir=export_dirs['userpics'],
+                                                                     refresh=getattr(config, 'refresh_userpics', False))
 
         if get_friend_pics.get('status', False) != 'ok':
-            log.critical("Something went wrong ' + get_friend_pics.get('reason', ' (unknown reason)")
-            sys.exit(1)
+            summary['status'] = 'error'
+            summary['reason'] = get_friend_pics.get('reason', '(unknown reason)')
+            return summary
 
     if True:
-        log.info("Downloading posts")
-        download_posts(export_dirs['posts_xml'])
+        log.info(f"Downloading posts for {journal}")
+        download_posts(export_dirs['posts_xml'], journal=journal)
 
-        log.info("Downloading comments")
-        download_comments(export_dirs['comments_xml'], export_dirs['lj_user'])
+        log.info(f"Downloading comments for {journal}")
+        download_comments(export_dirs['comments_xml'], export_dirs['lj_user'], journal=journal, shared_map=users_map)
 
     # Generate the all.json files from downloaded posts and comments
     if True:
         create_posts_json_all_file(export_dirs['posts_xml'], export_dirs['lj_user'])
-        create_comments_json_all_file(export_dirs['comments_xml'], export_dirs['lj_user'])
+        create_comments_json_all_file(export_dirs['comments_xml'], export_dirs['lj_user'], shared_map=users_map)
 
     if True:
-        with open(os.path.join(export_dirs['lj_user'], 'all_posts.json'), 'r') as f:
-            all_posts = json.load(f)
-        with open(os.path.join(export_dirs['lj_user'], 'all_comments.json'), 'r') as f:
-            all_comments = json.load(f)
+        all_posts = list(jsonstream.read_records(
+            jsonstream.records_filename(export_dirs['lj_user'], 'all_posts', JSON_FORMAT)))
+        all_comments = [Comment.from_dict(c) for c in jsonstream.read_records(
+            jsonstream.records_filename(export_dirs['lj_user'], 'all_comments', JSON_FORMAT))]
+
+        # Keep copies of embedded images, whose hosts may disappear, for the rendered pages to point at
+        media_urls = None
+        if getattr(config, 'archive_media', False):
+            media_urls = media.archive_embedded_media(all_posts, all_comments, export_dirs['media'],
+                                         os.path.join(export_dirs['lj_user'], media.MEDIA_MANIFEST_FILE),
+                                         STATIC_MEDIA_PART,
+                                         max_workers=getattr(config, 'media_max_workers', 8),
+                                         per_host=getattr(config, 'media_per_host', 2),
+                                         headers=config.header)
+
+        userpic_files = resolve_comment_userpics(all_comments, export_dirs)
 
-        combine(all_posts, all_comments, export_dirs)
+        combine(all_posts, all_comments, export_dirs, slugs=slugs, userpic_files=userpic_files, media_urls=media_urls)
+
+        summary['posts'] = len(all_posts)
+        summary['comments'] = len(all_comments)
+
+    # Typed column arrays of post and comment metadata, for analysis with numpy
+    if getattr(config, 'analytics_export', False):
+        analytics.export_columns(export_dirs['lj_user'])
+
+    summary['elapsed'] = time.monotonic() - start_time
+    return summary
+
+
+def journal_params(journal):
+    """ Extra request parameters for exporting a journal other than the logged-in user's, e.g. a community """
+    if journal and journal != config.username:
+        return {'authas': journal}
+
+    return {}
 
 
 def ensure_export_dirs(top_dir, lj_user, ensure_dirs):
@@ -109,161 +226,280 @@ def ensure_export_dirs(top_dir, lj_user, ensure_dirs):
 
 
 def find_files_by_pattern(filepat, top_dir):
+    # Raw downloads may be stored compressed, so match those too
+    filepats = rawstore.raw_patterns(filepat)
+
     for path, dirlist, filelist in os.walk(top_dir):
-        for name in fnmatch.filter(filelist, filepat):
-            yield os.path.join(path, name)
+        for name in filelist:
+            if any(fnmatch.fnmatch(name, p) for p in filepats):
+                yield os.path.join(path, name)
 
 
-def create_posts_json_all_file(posts_xml_dir, lj_user_dir):
-    xml_posts = []
+def iter_xml_elements(source, tag):
+    """ Yields complete `tag` elements from an XML string or binary file, without building the whole tree """
+    if isinstance(source, (str, bytes)):
+        yield from xml_element_tree.fromstring(source).iter(tag)
+        return
+
+    for event, elem in xml_element_tree.iterparse(source):
+        if elem.tag == tag:
+            yield elem
+            elem.clear()
 
+
+def iter_posts_from_xml(posts_xml_dir):
     xml_files = find_files_by_pattern('*.xml', posts_xml_dir)
     for xml_file in xml_files:
-        with open(xml_file, 'rt') as f:
-            xml_posts.extend(list(xml_element_tree.fromstring(f.read()).iter('entry')))
+        with rawstore.open_raw(xml_file) as f:
+            yield from map(post_xml_to_json, iter_xml_elements(f, 'entry'))
+
 
-    json_posts = list(map(post_xml_to_json, xml_posts))
-    posts_json_all_filename = os.path.join(lj_user_dir, 'all_posts.json')
-    with open(posts_json_all_filename, 'w') as f:
-        f.write(json.dumps(json_posts, ensure_ascii=False, indent=2))
+def create_posts_json_all_file(posts_xml_dir, lj_user_dir):
+    # Posts are written out as they are parsed, never all held at once
+    posts_json_all_filename = jsonstream.records_filename(lj_user_dir, 'all_posts', JSON_FORMAT)
+    return jsonstream.write_records(posts_json_all_filename, iter_posts_from_xml(posts_xml_dir),
+                                    fmt=JSON_FORMAT, indent=JSON_INDENT)
 
 
-def create_comments_json_all_file(comments_xml_dir, lj_user_dir):
-    all_comments = []
+def iter_comments_from_xml(comments_xml_dir, users):
+    # A comment_body page returns up to a page of comments from its startid, so a page started at a
+    # fixed id (as plan.py's chunks are) can repeat comments the page before it already returned.
+    # Newer pages are read first, so where pages disagree the latest download wins.
+    seen_ids = set()
 
+    xml_files = sorted(find_files_by_pattern('comment_body*.xml', comments_xml_dir), key=os.path.getmtime,
+                       reverse=True)
+    for xml_file in xml_files:
+        with rawstore.open_raw(xml_file) as f:
+            for comment in extract_comments_from_xml(f, users):
+                if comment.id not in seen_ids:
+                    seen_ids.add(comment.id)
+                    yield comment
+
+
+def create_comments_json_all_file(comments_xml_dir, lj_user_dir, shared_map=None):
     # Get usermap, mapping integer id to username of commentor
     usermap_json_filename = os.path.join(lj_user_dir, "comments_user_map.json")
     with open(usermap_json_filename) as f:
         users = json.load(f)
 
-    xml_files = find_files_by_pattern('comment_body*.xml', comments_xml_dir)
-    for xml_file in xml_files:
-        with open(xml_file, 'rt') as f:
-            new_comments = extract_comments_from_xml(f.read(), users)
-            all_comments.extend(new_comments)
-
-    comments_json_all_filename = os.path.join(lj_user_dir, "all_comments.json")
-    with open(comments_json_all_filename, 'w') as f:
-        f.write(json.dumps(all_comments, ensure_ascii=False, indent=2))
+    # In a bulk export, commenters missing from this journal's map may be known from the others
+    if shared_map is not None:
+        users = ChainMap(users, shared_map)
 
-    return
+    comments_json_all_filename = jsonstream.records_filename(lj_user_dir, 'all_comments', JSON_FORMAT)
+    return jsonstream.write_records(comments_json_all_filename,
+                                    (c.to_dict() for c in iter_comments_from_xml(comments_xml_dir, users)),
+                                    fmt=JSON_FORMAT, indent=JSON_INDENT)
 
 
 def extract_comments_from_xml(xml, user_map):
     comments = []
 
-    for comment_xml in xml_element_tree.fromstring(xml).iter('comment'):
-        comment = {
-            'jitemid': int(comment_xml.attrib['jitemid']),
-            'id': int(comment_xml.attrib['id']),
-            'children': []
-        }
-        get_comment_property('parentid', comment_xml, comment)
-        get_comment_property('posterid', comment_xml, comment)
-        get_comment_element('date', comment_xml, comment)
-        get_comment_element('subject', comment_xml, comment)
-        get_comment_element('body', comment_xml, comment)
+    for comment_xml in iter_xml_elements(xml, 'comment'):
+        posterid = get_comment_property('posterid', comment_xml)
+
+        # Parse the date once here; it's kept as epoch seconds plus a normalised ISO string
+        date = get_comment_element('date', comment_xml)
+        epoch = timestamps.parse(date)
+        if epoch is not None:
+            date = timestamps.iso(epoch)
+
+        comments.append(Comment(
+            id=int(comment_xml.attrib['id']),
+            jitemid=int(comment_xml.attrib['jitemid']),
+            parentid=get_comment_property('parentid', comment_xml),
+            posterid=posterid,
+            date=date,
+            epoch=epoch,
+            subject=get_comment_element('subject', comment_xml),
+            body=get_comment_element('body', comment_xml),
+            state=comment_xml.attrib.get('state'),
+            author=user_map.get(str(posterid), "deleted-user") if posterid is not None else None
+        ))
 
-        if 'state' in comment_xml.attrib:
-            comment['state'] = comment_xml.attrib['state']
+    return comments
 
-        if 'posterid' in comment:
-            comment['author'] = user_map.get(str(comment['posterid']), "deleted-user")
 
-        comments.append(comment)
+# Comment metadata is paged, and used to build the usermap
+def download_comment_metadata(comments_xml_dir, lj_user_dir, journal=None):
+    return build_users_map(comments_xml_dir, lj_user_dir, journal=journal)
 
-    return comments
 
+def get_comment_metadata_page(comments_xml_dir, start_id=0, journal=None, force=False):
+    metadata_file = Path(comments_xml_dir, f'comment_meta-{str(start_id)}.xml')
+    stored_file = rawstore.find_raw(metadata_file)
+
+    if stored_file and not force:
+        # metadata downloaded, read it in
+        log.info(f"  Reading local file for metadata: {stored_file.name}")
+        return etree.XML(rawstore.read_raw(stored_file))
 
-# Comment metadata is paged, and used to build the usermap
-def download_comment_metadata(comments_xml_dir, lj_user_dir):
-    log.info(f"Fetching comment metadata, starting at comment {str(start_id)}")
+    log.info(f"  Downloading file for comment_meta-{str(start_id)}.xml")
+    LJ_RATE_LIMIT.wait()
+    response = requests.get(
+        'http://www.livejournal.com/export_comments.bml',
+        params={'get': 'comment_meta', 'startid': start_id, **journal_params(journal)},
+        headers=config.header,
+        cookies=get_cookies()
+    )
+
+    if response.status_code != requests.codes.ok:
+        log.error(f"  Could not download comment_meta-{str(start_id)}.xml: HTTP {response.status_code}")
+        return None
 
-    for metadata_xml in get_comment_metadata_xml(comments_xml_dir):
-        update_users_map(metadata_xml, lj_user_dir)
+    rawstore.write_raw(metadata_file, response.content, RAW_COMPRESSION)
+    # note r.content used, not r.text, to avoid encoding mismatch error from lxml
+    return etree.XML(response.content)
 
 
-def get_comment_metadata_xml(comments_xml_dir, start_id=0):
+def get_comment_metadata_xml(comments_xml_dir, start_id=0, journal=None, force_first=False):
+    """ Yields (start_id, root) for each page of comment metadata, following nextid until maxid """
     log.info("Fetching comment metadata for usermap")
-    metadata_file = Path(comments_xml_dir, f'comment_meta-{str(start_id)}.xml')
+    force = force_first
 
-    if metadata_file.is_file():
-        # metadata downloaded, read it in
+    while True:
+        root = get_comment_metadata_page(comments_xml_dir, start_id, journal=journal, force=force)
+        if root is None:
+            return
 
-        log.info(f"  Reading local file for metadata: comment_meta-{str(start_id)}.xml")
-        with open(metadata_file, 'rb') as f:
-            root = etree.XML(f.read())
+        yield start_id, root
+        force = False
 
-    else:
+        max_id = root.findtext('maxid')
+        next_id = root.findtext('nextid')
+        if not (next_id and max_id and int(next_id) < int(max_id)):
+            return
+
+        start_id = int(next_id)
+
+
+def build_users_map(comments_xml_dir, lj_user_dir, journal=None, extend=False, resume=True, checkpoint_pages=100):
+    """
+    Builds the commenter id -> username map from the comment metadata pages.
+
+    Pages are merged in memory and the map is written once at the end, plus every checkpoint_pages
+    pages so an interrupted run keeps its progress; the state file says whether the map is complete.
+    An incomplete map is picked up from its last checkpoint unless resume is False.  With extend, a
+    complete map is continued from the last page read the previous time (that page is downloaded
+    again, as it may have grown).
+    """
+    usermap_file = Path(lj_user_dir, 'comments_user_map.json')
+    state_file = Path(lj_user_dir, 'comments_user_map_state.json')
+
+    users_map = {}
+    start_id = 0
+
+    previous_state = read_users_map_state(lj_user_dir)
+    if usermap_file.is_file() and previous_state and (extend or resume and not previous_state.get('complete', True)):
+        with open(usermap_file, 'r') as f:
+            users_map = json.load(f)
+        start_id = previous_state.get('last_start_id', 0)
 
-        log.info(f"  Downloading file for comment_meta-{str(start_id)}.xml")
-        response = requests.get(
-            'http://www.livejournal.com/export_comments.bml',
-            params={'get': 'comment_meta', 'startid': start_id},
-            headers=config.header,
-            cookies=get_cookies()
-        )
+    state = {'last_start_id': start_id, 'complete': False}
+    pages = 0
 
-        if requests.codes.ok:
-            with open(metadata_file, 'w') as f:
-                f.write(response.text)
-                # note r.content used, not r.text, to avoid encoding mismatch error from lxml
-                root = etree.XML(response.content)
+    for page_start_id, metadata_xml in get_comment_metadata_xml(comments_xml_dir, start_id=start_id, journal=journal,
+                                                                force_first=extend):
+        merge_users_map(metadata_xml, users_map)
+        state = {'last_start_id': page_start_id, 'maxid': metadata_xml.findtext('maxid'), 'complete': False}
+        pages += 1
 
-    yield root
+        if checkpoint_pages and pages % checkpoint_pages == 0:
+            write_json_atomic(usermap_file, users_map)
+            write_json_atomic(state_file, state)
 
-    max_id = root.findtext('maxid')
-    next_id = root.findtext('nextid')
-    if next_id and (int(next_id) < int(max_id)):
-        yield from get_comment_metadata_xml(comments_xml_dir, start_id=next_id)
+    write_json_atomic(usermap_file, users_map)
+    write_json_atomic(state_file, {**state, 'complete': True})
 
+    log.info(f"Usermap has {len(users_map)} users after reading {pages} metadata pages")
+    return users_map
+
+
+def read_users_map_state(lj_user_dir):
+    """ build_users_map's state: last_start_id, maxid and complete, or {} if there's none """
+    state_file = Path(lj_user_dir, 'comments_user_map_state.json')
+    if not state_file.is_file():
+        return {}
+
+    with open(state_file, 'r') as f:
+        return json.load(f)
+
+
+def users_map_state_max_id(lj_user_dir):
+    """ The maxid of the metadata page build_users_map read last, or -1 """
+    return int(read_users_map_state(lj_user_dir).get('maxid') or -1)
 
-def download_comments(comments_xml_dir, lj_user_dir):
+
+def download_comments(comments_xml_dir, lj_user_dir, journal=None, shared_map=None, start_id=0, end_id=None,
+                      reuse_pages=False):
     # Get users from usermap file
-    users = get_users_map(comments_xml_dir, lj_user_dir)
+    extend = getattr(config, 'extend_usermap', False)
+    users = get_users_map(comments_xml_dir, lj_user_dir, extend=extend, journal=journal, shared_map=shared_map)
 
     log.info("Fetching comment max_id")
-    metadata_file = Path(comments_xml_dir, f'comment_meta-0.xml')
-    if not metadata_file.is_file():
-        get_comment_metadata_xml(comments_xml_dir)
+    root = get_comment_metadata_page(comments_xml_dir, 0, journal=journal)
+    if root is None:
+        return
 
-    with open(metadata_file, 'rb') as f:
-        root = etree.XML(f.read())
-        max_id = root.findtext('maxid')
-        del root
+    max_id = int(root.findtext('maxid'))
+    del root
+
+    # Extending the usermap downloaded its last page again, so its maxid is newer than the stored page 0's
+    if extend:
+        max_id = max(max_id, users_map_state_max_id(lj_user_dir))
 
-    start_id = -1
-    while start_id < int(max_id):
-        start_id, comments = get_more_comments(start_id + 1, users, comments_xml_dir)
+    # end_id limits the download to a range of comment ids, as in the chunks made by plan.py
+    if end_id is not None:
+        max_id = min(max_id, end_id)
 
+    # Progress is counted in comment ids, which maxid gives a total for up front
+    stage = progress.start('comments', total=max(max_id - start_id + 1, 0), journal=journal)
+
+    start_id = start_id - 1
+    while start_id < max_id:
+        last_id = start_id
+        start_id, comments = get_more_comments(start_id + 1, users, comments_xml_dir, journal=journal,
+                                               reuse=reuse_pages)
+        stage.advance(min(start_id, max_id) - last_id)
+
+    stage.finish()
     return
 
 
-def get_users_map(comments_xml_dir, lj_user_dir, force=False):
+def get_users_map(comments_xml_dir, lj_user_dir, force=False, extend=False, journal=None, shared_map=None):
     usermap_file = Path(lj_user_dir, 'comments_user_map.json')
 
-    # Create it if not present, or forced
-    if not usermap_file.is_file() or force:
-        for metadata_xml in get_comment_metadata_xml(comments_xml_dir):
-            update_users_map(metadata_xml, lj_user_dir)
+    # Create it if not present or forced, finish it if an earlier build was interrupted, pick up new
+    # commenters if extending, otherwise read it in
+    if not usermap_file.is_file() or force or extend or not read_users_map_state(lj_user_dir).get('complete', True):
+        users_map = build_users_map(comments_xml_dir, lj_user_dir, journal=journal, extend=extend and not force,
+                                    resume=not force)
+    else:
+        with open(usermap_file, 'r') as f:
+            users_map = json.load(f)
 
-    # Read it in
-    with open(usermap_file, 'r') as f:
-        users_map = json.load(f)
+    # Poster ids are global to LJ, so one map can serve every journal in a bulk export
+    if shared_map is not None:
+        shared_map.update(users_map)
+        return shared_map
 
     return users_map
 
 
 def fix_user_links(json_dict):
-    """ replace user links with usernames """
+    """ replace user links with usernames, and return the body as HTML for the HTML and for the Markdown output """
     if 'subject' in json_dict:
-        json_dict['subject'] = USER.sub(r'\1', json_dict['subject'])
+        json_dict['subject'] = bodytext.transform(json_dict['subject']).text
 
+    body = bodytext.transform(json_dict.get('body', ''))
     if 'body' in json_dict:
-        json_dict['body'] = USER.sub(r'\1', json_dict['body'])
+        json_dict['body'] = body.text
+
+    return body.html, body.md_html
 
 
-def post_json_to_html(json_dict):
+def post_json_to_html(json_dict, body_html):
     return """<!doctype html>
 <meta charset="utf-8">
 <title>{subject}</title>
@@ -273,11 +509,11 @@ def post_json_to_html(json_dict):
 </article>
 """.format(
         subject=json_dict['subject'] or json_dict['date'],
-        body=TAGLESS_NEWLINES.sub('<br>\n', json_dict['body'])
+        body=body_html
     )
 
 
-def get_slug(json_dict):
+def get_slug(json_dict, slugs=SLUGS):
     slug = json_dict.get('subject', json_dict['id'])
     if not len(slug):
         slug = json_dict['id']
@@ -285,37 +521,34 @@ def get_slug(json_dict):
     slug = slug.lower()
 
     # change everything not in [a-zA-Z0-9] to -
-    slug = re.compile(r'\W+|_').sub('-', slug)
+    slug = SLUG_NOT_WORDS.sub('-', slug)
 
     # remove leading and trailing -
-    slug = re.compile(r'^-|-$').sub('', slug)
+    slug = SLUG_EDGE_DASH.sub('', slug)
 
     # remove multi-dashes
-    slug = re.compile(r'-+').sub('-', slug)
+    slug = SLUG_DASHES.sub('-', slug)
 
-    if slug in SLUGS:
+    if slug in slugs:
         slug += (len(slug) and '-' or '') + json_dict['id']
 
-    SLUGS[slug] = True
+    slugs[slug] = True
 
     return slug
 
 
-def json_to_markdown(json_dict):
-    body = TAGLESS_NEWLINES.sub('<br>', json_dict['body'])
-
+def json_to_markdown(json_dict, body_html):
     h = html2text.HTML2Text()
     h.body_width = 0
     h.unicode_snob = True
-    body = h.handle(body)
-    body = NEWLINES.sub('\n\n', body)
+    body = h.handle(body_html)
 
-    # read UTX tags
-    tags = TAG.findall(body)
+    # collapse blank lines, and read the UTX tags while removing them from the text
+    body, tags = bodytext.clean_markdown(body)
+    json_dict['tag_list'] = tags
     json_dict['tags'] = len(tags) and '\ntags: {0}'.format(', '.join(tags)) or ''
 
-    # remove UTX tags from text
-    json_dict['body'] = TAG.sub('', body).strip()
+    json_dict['body'] = body.strip()
 
     # json_dict['slug'] = get_slug(json_dict)
     json_dict['subject'] = json_dict['subject'] or json_dict['date']
@@ -336,73 +569,63 @@ Security (from LJ): {security}
 
 
 def group_comments_by_post(comments):
-    posts = {}
+    return group_by_post(comments)
 
-    for comment in comments:
-        post_id = comment['jitemid']
-
-        if post_id not in posts:
-            posts[post_id] = {}
 
-        post = posts[post_id]
-        post[comment['id']] = comment
+def fix_comment_user_links(comment):
+    """ replace user links with usernames, and return the body rendered to HTML (None if there's no body) """
+    if comment.subject:
+        comment.subject = bodytext.transform(comment.subject).text
 
-    return posts
+    if comment.body is None:
+        return None
 
+    body = bodytext.transform(comment.body)
+    comment.body = body.text
 
-def nest_comments(comments):
-    post = []
+    # Deleted comments aren't shown
+    return not comment.deleted and markdown.markdown(body.html) or None
 
-    for comment in comments.values():
-        fix_user_links(comment)
 
-        if 'parentid' not in comment:
-            post.append(comment)
-        else:
-            comments[comment['parentid']]['children'].append(comment)
+def nest_comments(comments, media_urls=None):
+    """ The post's CommentThread, and the rendered bodies of its comments in the same order """
+    thread = CommentThread(comments)
+    bodies = [media.rewrite_image_urls(fix_comment_user_links(comment), media_urls) for comment in thread.comments]
 
-    return post
+    return thread, bodies
 
 
-def comment_to_li(comment):
-    if 'state' in comment and comment['state'] == 'D':
-        return ''
+def comment_to_li(comment, body_html):
+    """ Opening <li> and content of one comment; comments_to_html closes it after the replies """
+    html = '<h3>{0}: {1}</h3>'.format(comment.author or 'Anonymous', comment.subject or '')
+    html += '\n<a id="comment-{0}"></a>'.format(comment.id)
 
-    html = '<h3>{0}: {1}</h3>'.format(comment.get('author', 'Anonymous'), comment.get('subject', ''))
-    html += '\n<a id="comment-{0}"></a>'.format(comment['id'])
+    if body_html is not None:
+        html += '\n' + body_html
 
-    if 'body' in comment:
-        html += '\n' + markdown.markdown(TAGLESS_NEWLINES.sub('<br>\n', comment['body']))
+    subject_class = comment.subject is not None and ' class=subject' or ''
+    return '<li{0}>{1}'.format(subject_class, html)
 
-    if len(comment['children']) > 0:
-        html += '\n' + comments_to_html(comment['children'])
 
-    subject_class = 'subject' in comment and ' class=subject' or ''
-    return '<li{0}>{1}\n</li>'.format(subject_class, html)
-
-
-def make_md_comment(comment, export_dirs, level=0):
+def make_md_comment(comment, userpic_html, body_html, level=0):
     """
     For static site generators like Pelican.
     See http://docs.getpelican.com/en/stable/content.html#file-metadata for details
 
     Relies on python-markdown extension for adding classes via attribute lists
     https://pythonhosted.org/Markdown/extensions/attr_list.html
-    """
 
-    # Ensure the userpic is present, or use the default one
-    commenting_user = comment.get('author', 'anonymous')
+    Renders a single comment; replies are rendered separately by comments_to_md.
+    userpic_html maps usernames to the markup showing their pic, as made by userpic_markup, and
+    body_html is the body as rendered by nest_comments.
+    """
 
-    userpic = userpics.get_userpic(commenting_user, copy_dir=export_dirs['userpics'])
-    userpic_file = userpic.get('filename', None)
-    if userpic_file is None:
-        userpic_file = userpics.DEFAULT_USERPIC_FILE
+    # The userpic was fetched before rendering, or use the default one
+    commenting_user = comment.author or 'anonymous'
 
     md = ''
-    if 'state' in comment and comment['state'] == 'D':
-        return ''
-
-    comment_date_str = arrow.get(comment['date']).format('MMMM D YYYY, HH:mm:ss')
+    epoch = comment.epoch if comment.epoch is not None else timestamps.parse(comment.date)
+    comment_date_str = epoch is not None and timestamps.display(epoch) or (comment.date or '')
 
     # Full container for comment
     md += '<div class=lj-comment-wrap style="margin-left:' + str(level * 25) + 'px;">\n'
@@ -411,8 +634,7 @@ def make_md_comment(comment, export_dirs, level=0):
     md += "<div class=lj-comment-head>\n"  # Userpic.
 
     md += "<div class=lj-comment-userpic>\n"
-    img_src = '<img src="/' + STATIC_USERPIC_PART + '/' + userpic_file + '" width="100" height="100">\n'
-    md += img_src
+    md += userpic_html.get(commenting_user) or userpic_img(userpics.DEFAULT_USERPIC_FILE)
     md += "</div>\n"
 
     # Comment ljusername and datetime
@@ -425,130 +647,237 @@ def make_md_comment(comment, export_dirs, level=0):
     md += "</div>\n"  # close lj-comment-head-in
     md += "</div>\n"  # close lj-comment-head
 
-    if 'body' in comment:
+    if body_html is not None:
         md += "<div class=lj-comment-text>\n"
-        md_body = markdown.markdown(TAGLESS_NEWLINES.sub('<br>\n', comment['body']))
-        # print(comment['body'])
-        md += md_body
+        md += body_html
         md += "</div>\n"
 
     # Close comment container
     md += "</div>\n\n"
 
-    # Children aren't nested, but are rather indented via their class attributes.
-    if len(comment['children']) > 0:
-        sorted_children = sorted(comment['children'], key=itemgetter('id'))
-        child_comments = [make_md_comment(c, export_dirs, level + 1) for c in sorted_children]
-        md += '\n'.join(child_comments)
+    return markdown.markdown(md, extensions=['markdown.extensions.extra'])
+
+
+def is_deleted(comment):
+    return comment.deleted
 
-    # print(comment.get('author', 'anonymous')+"\n------------")
 
-    rv_md = markdown.markdown(md, ['markdown.extensions.extra'])
-    # print(rv_md)
+def comments_to_html(thread, bodies):
+    # Deleted comments are dropped along with their replies
+    parts = ['<ul>']
 
-    return rv_md
+    for i, level, entering in thread.walk(skip=is_deleted):
+        has_children = len(thread.children(i)) > 0
 
+        if entering:
+            parts.append('\n' + comment_to_li(thread.comments[i], bodies[i]))
+            if has_children:
+                parts.append('\n<ul>')
+        else:
+            if has_children:
+                parts.append('\n</ul>')
+            parts.append('\n</li>')
 
-def comments_to_html(comments):
-    return '<ul>\n{0}\n</ul>'.format('\n'.join(map(comment_to_li, sorted(comments, key=itemgetter('id')))))
+    parts.append('\n</ul>')
+    return ''.join(parts)
 
 
-def comments_to_md(comments, export_dirs):
+def comments_to_md(thread, userpic_html, bodies, stylesheet=''):
     rv = "<hr>\n"
     rv += "###Comments\n\n"
-    sorted_comments = sorted(comments, key=itemgetter('id'))
-    md_comments = [make_md_comment(c, export_dirs) for c in sorted_comments]
+
+    # The sprite sheet classes used by the userpics
+    if stylesheet:
+        rv += "<div class=lj-comment-styles>" + stylesheet + "</div>\n\n"
+
+    # Children aren't nested, but are rather indented via their class attributes.
+    # walk() gives them in display order with their depth, so there's no recursion or re-sorting.
+    md_comments = [make_md_comment(thread.comments[i], userpic_html, bodies[i], level)
+                   for i, level, entering in thread.walk(skip=is_deleted) if entering]
     rv += '\n'.join(md_comments)
     return rv
 
 
-def save_as_json(json_post, post_comments, posts_json_dir):
+# The save_as_ functions hand their files to an OutputWriter, with paths relative to the lj_user directory
+
+def save_as_json(json_post, post_comments, writer):
     json_id = json_post['id']
-    json_data = {'id': json_id, 'post': json_post, 'comments': post_comments}
-    json_filename = os.path.join(posts_json_dir, '{0}.json'.format(json_id))
-    with open(json_filename, 'w') as json_file:
-        json_file.write(json.dumps(json_data, ensure_ascii=False, indent=2))
+    json_data = {'id': json_id, 'post': json_post, 'comments': None}
+    json_text = json.dumps(json_data, ensure_ascii=False, indent=JSON_INDENT)
+
+    # The comments go in as text, since json.dumps can't nest as deep as a long reply chain, and are
+    # streamed to the writer a comment at a time rather than built into one string
+    if post_comments:
+        head, tail = json_text.rsplit('null', 1)
+        json_text = chain([head], post_comments.iter_nested_json(indent=JSON_INDENT, level=1), [tail])
 
+    json_filename = os.path.join('posts_json', '{0}.json'.format(json_id))
+    writer.write(json_filename, json_text, key=json_id)
 
-def save_as_markdown(json_post, subfolder, post_comments_md,
-                     posts_markdown_dir):
-    parent_md_dir = os.path.join(posts_markdown_dir, subfolder)
-    os.makedirs(parent_md_dir, exist_ok=True)
 
-    md_filename = os.path.join(parent_md_dir, json_post['slug'] + ".md")
-    with open(md_filename, 'w') as md_file:
-        md_file.write(json_to_markdown(json_post))
+def save_as_markdown(json_post, subfolder, body_html, post_comments_md, writer):
+    md_filename = os.path.join('posts_markdown', subfolder, json_post['slug'] + ".md")
 
-        if post_comments_md:
-            md_file.write('\n' + post_comments_md)
+    md_text = json_to_markdown(json_post, body_html)
+    if post_comments_md:
+        md_text += '\n' + post_comments_md
 
+    writer.write(md_filename, md_text, key=json_post['id'])
 
-def save_as_html(json_post, subfolder, post_comments_html, posts_html_dir):
+
+def save_as_html(json_post, subfolder, body_html, post_comments_html, writer):
     post_id = json_post['id']
+    html_filename = os.path.join('posts_html', subfolder, post_id + ".html")
+
+    html_text = post_json_to_html(json_post, body_html)
+    if post_comments_html:
+        html_text += '\n<h2>Comments</h2>\n' + post_comments_html
+
+    writer.write(html_filename, html_text, key=post_id)
+
+
+def resolve_comment_userpics(comments, export_dirs):
+    """ Fetches the pics of everyone who commented, and returns a read-only username -> filename map """
+    authors = {comment.author or 'anonymous' for comment in comments if not comment.deleted}
+    log.info(f"Resolving userpics for {len(authors)} commenters")
+
+    return userpics.resolve_userpics(authors, copy_dir=export_dirs['userpics'],
+                                     max_workers=getattr(config, 'userpic_max_workers', 2))
+
+
+def userpic_img(userpic_file):
+    return '<img src="/' + STATIC_USERPIC_PART + '/' + userpic_file + '" width="100" height="100">\n'
+
+
+def userpic_markup(userpic_files, comments, export_dirs):
+    """
+    ({username: markup showing their pic}, stylesheet link or '') for the comments, made once per
+    user.  With userpic_assets set they show the optimized copies, with the busiest commenters
+    first in the sprite sheets.
+    """
+    markup = {username: userpic_img(userpic_file) for username, userpic_file in userpic_files.items()}
+    if not USERPIC_ASSETS:
+        return markup, ''
+
+    busiest = [username for username, _ in
+               Counter(c.author or 'anonymous' for c in comments if not c.deleted).most_common()]
+    assets = picassets.build_assets(userpic_files, export_dirs['userpics'], export_dirs['userpic_assets'],
+                                    fmt=USERPIC_ASSETS, sprites=USERPIC_SPRITES, sprite_size=USERPIC_SPRITE_SIZE,
+                                    order=busiest)
+
+    for username, asset in assets.items():
+        markup[username] = picassets.markup(asset, STATIC_USERPIC_ASSETS_PART, username)
 
-    parent_dir = os.path.join(posts_html_dir, subfolder)
-    os.makedirs(parent_dir, exist_ok=True)
+    return markup, USERPIC_SPRITES and assets and picassets.stylesheet_link(STATIC_USERPIC_ASSETS_PART) or ''
 
-    html_filename = os.path.join(parent_dir, post_id + ".html")
-    with open(html_filename, 'w') as html_file:
-        html_file.writelines(post_json_to_html(json_post))
-        if post_comments_html:
-            html_file.write('\n<h2>Comments</h2>\n' + post_comments_html)
 
-            # if post_comments_html:
-            #     parent_comments_dir = os.path.join(comments_html_dir, year_dir, month_dir)
-            #     os.makedirs(parent_comments_dir, exist_ok=True)
-            #
-            #     html_comments_filename = os.path.join(parent_comments_dir, json_post['slug'] + ".html")
-            #     with open(html_comments_filename, 'w') as f:
-            #         f.write(post_comments_html)
+def combine(posts, comments, export_dirs, slugs=None, writer=None, userpic_files=None, media_urls=None):
+    """
+    userpic_files is the map from resolve_comment_userpics; without it, combine resolves the pics first.
+    media_urls (from media.archive_embedded_media) points the images in the HTML and Markdown at local copies.
+    """
+    if slugs is None:
+        slugs = SLUGS
+
+    # Rendering only reads this map, so it never waits on the network or the userpic metadata file
+    if userpic_files is None:
+        userpic_files = resolve_comment_userpics(comments, export_dirs)
+    userpic_html, userpic_stylesheet = userpic_markup(userpic_files, comments, export_dirs)
 
+    own_writer = writer is None
+    if own_writer and OUTPUT_ARCHIVE:
+        writer = outwriter.ArchiveWriter(os.path.join(export_dirs['lj_user'], f'export.{OUTPUT_ARCHIVE}'),
+                                         OUTPUT_ARCHIVE)
+    elif own_writer:
+        writer = outwriter.OutputWriter(export_dirs['lj_user'], threads=OUTPUT_THREADS)
+
+    # Collects what the index, archive and tag pages need while the posts go by
+    site = pages.SiteAggregator(per_page=getattr(config, 'index_page_size', 50))
 
-def combine(posts, comments, export_dirs):
     posts_comments = group_comments_by_post(comments)
 
     num_posts = len(posts)
+    journal = os.path.basename(export_dirs['lj_user'])
+
+    search_index = SEARCH_INDEX and search.SearchIndex(os.path.join(export_dirs['lj_user'], search.SEARCH_DB_FILE))
+
+    stage = progress.start('render', total=num_posts, journal=journal)
 
-    start_time = datetime.now()
-    for i, json_post in enumerate(posts):
+    for json_post in posts:
         post_id = json_post['id']
-        log.info(f'Generating post for {json_post["date"]}, {i+1} of {num_posts}')
 
         jitemid = int(post_id) >> 8
 
-        date = datetime.strptime(json_post['date'], '%Y-%m-%d %H:%M:%S')
-        subfolder_year = '{0.year}'.format(date)
-        subfolder_month = '{0.month:02d}'.format(date)
-        subfolder = os.path.join(subfolder_year, subfolder_month)
+        post_epoch = json_post.get('epoch') or timestamps.parse(json_post['date']) \
+            or timestamps.parse(json_post.get('logtime'))
+        post_month = timestamps.year_month(post_epoch)
+        if post_month is None:
+            log.warning(f"Post {post_id} has no readable date ({json_post['date']!r}), skipped")
+            stage.advance()
+            continue
+
+        year, month = post_month
+        subfolder = os.path.join(str(year), '{0:02d}'.format(month))
+
+        # Bodies are transformed once here, and the rendered HTML shared by the output formats
+        post_comments, comment_bodies = jitemid in posts_comments and \
+            nest_comments(posts_comments[jitemid], media_urls) or (None, None)
+        post_comments_html = post_comments and comments_to_html(post_comments, comment_bodies) or ''
+        post_comments_md = post_comments and \
+            comments_to_md(post_comments, userpic_html, comment_bodies, userpic_stylesheet) or ''
 
-        post_comments = jitemid in posts_comments and nest_comments(posts_comments[jitemid]) or None
-        post_comments_html = post_comments and comments_to_html(post_comments) or ''
-        post_comments_md = post_comments and comments_to_md(post_comments, export_dirs) or ''
+        body_html, body_md_html = (media.rewrite_image_urls(html, media_urls) for html in fix_user_links(json_post))
+        json_post['slug'] = get_slug(json_post, slugs)
 
-        fix_user_links(json_post)
-        json_post['slug'] = get_slug(json_post)
+        if search_index:
+            search_index.update_post(json_post, post_comments, author=journal)
 
         save_as_json(json_post,
                      post_comments,
-                     export_dirs['posts_json'])
+                     writer)
 
         save_as_html(json_post,
                      subfolder,
+                     body_html,
                      post_comments_html,
-                     export_dirs['posts_html'])
+                     writer)
 
         save_as_markdown(json_post,
                          subfolder,
+                         body_md_html,
                          post_comments_md,
-                         export_dirs['posts_markdown']
-                         )
+                         writer)
+
+        site.add_post(json_post, subfolder, post_epoch, post_comments, json_post['tag_list'])
+        stage.advance()
+
+    stage.finish()
+    site.write_pages(writer)
+
+    # An archive holds the whole site, so it also gets the pictures the pages link to
+    if isinstance(writer, outwriter.ArchiveWriter):
+        writer.add_directory(export_dirs['userpics'], 'userpics')
+        writer.add_directory(export_dirs['userpic_assets'], 'userpic_assets')
+        writer.add_directory(export_dirs['media'], 'media')
 
+    if own_writer:
+        writer.close()
+        log.info(f"Wrote {writer.written} files, {writer.unchanged} unchanged")
 
+    if search_index:
+        search_index.prune(p['id'] for p in posts)
+        log.info(f"Search index: {search_index.changed} posts updated")
+
+        if SEARCH_SHARDS and search_index.changed:
+            search_index.write_json_shards(os.path.join(export_dirs['posts_html'], 'search'))
+
+        search_index.close()
 
 
 # Downloads for posts
 
-def fetch_month_posts(year, month):
+def fetch_month_posts(year, month, journal=None):
+    LJ_RATE_LIMIT.wait()
     response = requests.post(
         'http://www.livejournal.com/export_do.bml',
         headers=config.header,
@@ -567,7 +896,8 @@ def fetch_month_posts(year, month):
             'field_event': 'on',
             'field_security': 'on',
             'field_allowmask': 'on',
-            'field_currents': 'on'
+            'field_currents': 'on',
+            **journal_params(journal)
         }
     )
 
@@ -578,12 +908,15 @@ def post_xml_to_json(xml):
     def f(field):
         return xml.find(field).text
 
+    date = f('eventtime')
+
     return {
         'id': f('itemid'),
         'logtime': f('logtime'),
         'subject': f('subject') or '',
         'body': f('event'),
-        'date': f('eventtime'),
+        'date': date,
+        'epoch': timestamps.parse(date),
         'security': f('security'),
         'allowmask': f('allowmask'),
         'current_music': f('current_music'),
@@ -591,118 +924,290 @@ def post_xml_to_json(xml):
     }
 
 
-def download_posts(posts_xml_dir):
+def download_posts(posts_xml_dir, journal=None, years_and_months=None):
+    if POST_BACKEND == 'flat':
+        if years_and_months is not None:
+            log.warning("The flat post backend syncs the whole journal, not a list of months")
+        return download_posts_flat(posts_xml_dir, journal=journal)
+
     start_date = config.start_date
     end_date = config.end_date
 
-    years_and_months = [(int(d[0].format('YYYY')), int(d[0].format('M')))
-                        for d in arrow.Arrow.span_range('month', arrow.get(start_date), arrow.get(end_date))]
+    if years_and_months is None:
+        years_and_months = timestamps.month_range(start_date, end_date)
+
+    stage = progress.start('posts', total=len(years_and_months), journal=journal)
 
     for year, month in years_and_months:
         posts_xml_filename = Path(posts_xml_dir, f'{year}-{month:02d}.xml')
 
-        if posts_xml_filename.is_file():
-            log.info(f"Not downloading posts for {year}-{month:02d}, downloaded already")
-            continue
+        if rawstore.find_raw(posts_xml_filename):
+            log.debug(f"Not downloading posts for {year}-{month:02d}, downloaded already")
+        else:
+            xml = fetch_month_posts(year, month, journal=journal)
+            log.debug(f"Downloading posts for {year}-{month:02d}")
+            rawstore.write_raw(posts_xml_filename, xml, RAW_COMPRESSION)
 
-        xml = fetch_month_posts(year, month)
-        log.info(f"Downloading posts for {year}-{month:02d}")
-        with open(posts_xml_filename, 'w+', encoding="utf8") as file:
-            file.write(xml)
+        stage.advance()
 
+    stage.finish()
     return
 
+
+def download_posts_flat(posts_xml_dir, journal=None):
+    """
+    Posts through the flat protocol: syncitems lists the entries created or changed since the last
+    run, and getevents fetches only those, in batches of about FLAT_BATCH_BYTES per response.
+
+    They're merged into the same month files of <entry> records that export_do.bml gives, so the rest
+    of the export reads them as usual.  Entries deleted on LJ are left in place.
+    """
+    sync_file = os.path.join(posts_xml_dir, FLAT_SYNC_FILE)
+    lastsync = None
+    if os.path.isfile(sync_file):
+        with open(sync_file) as f:
+            lastsync = json.load(f).get('lastsync')
+
+    items, newsync = sync_items(journal, lastsync)
+    log.info(f"{len(items)} posts new or changed since {lastsync or 'the start'}")
+
+    months = set(timestamps.month_range(config.start_date, config.end_date))
+    pending = sorted(items)
+    batch_size = FLAT_BATCH_SIZE
+    stage = progress.start('posts', total=len(items), journal=journal)
+    skipped_since = None
+
+    while pending:
+        batch, pending = pending[:batch_size], pending[batch_size:]
+        events, size = get_events(batch, journal)
+
+        by_month = {}
+        for event in events:
+            event['logtime'] = event['logtime'] or items[int(event['itemid']) >> 8]
+            year_month = timestamps.year_month(timestamps.parse(event['eventtime'])
+                                               or timestamps.parse(event['logtime']))
+            if year_month is None:
+                log.warning(f"Post {event['itemid']} has no readable date ({event['eventtime']!r}), skipped")
+            elif year_month in months:
+                by_month.setdefault(year_month, []).append(event)
+            else:
+                # Outside start_date..end_date: synced again next time, in case the range is widened
+                changed = items[int(event['itemid']) >> 8]
+                skipped_since = min(skipped_since or changed, changed)
+
+        for (year, month), month_events in by_month.items():
+            merge_month_entries(Path(posts_xml_dir, f'{year}-{month:02d}.xml'), month_events)
+
+        stage.advance(len(batch))
+
+        # Size the next batch from this one's bytes per entry, so busy stretches don't give huge responses
+        batch_size = max(1, min(FLAT_BATCH_SIZE, int(FLAT_BATCH_BYTES * len(batch) / max(size, 1))))
+
+    stage.finish()
+
+    # syncitems gives what changed after lastsync, so it's kept just before the earliest skipped entry
+    if skipped_since:
+        newsync = min(newsync, timestamps.format_sync_time(timestamps.parse(skipped_since) - 1))
+        log.info(f"Posts outside the date range changed since {skipped_since}, which will be synced again")
+
+    write_json_atomic(sync_file, {'lastsync': newsync})
+
+
+def flat_request(mode, journal=None, **params):
+    """ One /interface/flat call, authenticated with the run's ljsession, as a dict """
+    LJ_RATE_LIMIT.wait()
+    response = requests.post(
+        config.lj_server + '/interface/flat',
+        headers={**config.header, 'X-LJ-Auth': 'cookie'},
+        cookies=get_cookies(),
+        data={
+            'mode': mode,
+            'user': config.username,
+            'auth_method': 'cookie',
+            'ver': 1,
+            **({'usejournal': journal} if journal and journal != config.username else {}),
+            **params
+        }
+    )
+
+    flat = flatten_string_pairs_to_dict(response.content.decode('utf-8', errors='replace'))
+    if flat.get('success') != 'OK':
+        raise RuntimeError(f"LJ {mode} failed: {flat.get('errmsg', '(no error message)')}")
+
+    return flat, len(response.content)
+
+
+def sync_items(journal=None, lastsync=None):
+    """
+    ({jitemid: time changed}, newest change time) for the entries created or changed since lastsync.
+    syncitems gives them oldest first, a page at a time, so it's called until it has given them all.
+    """
+    items = {}
+
+    while True:
+        flat, _ = flat_request('syncitems', journal, **(lastsync and {'lastsync': lastsync} or {}))
+        count = int(flat.get('sync_count', 0))
+
+        for n in range(1, count + 1):
+            item, changed = flat[f'sync_{n}_item'], flat[f'sync_{n}_time']
+            if item.startswith('L-'):
+                items[int(item[2:])] = changed
+            lastsync = max(lastsync or '', changed)
+
+        if not count or count >= int(flat.get('sync_total', 0)):
+            return items, lastsync
+
+
+def get_events(jitemids, journal=None):
+    """ ([entries as dicts of ENTRY_FIELDS], response size) for the given entries, in one getevents call """
+    flat, size = flat_request('getevents', journal, selecttype='multiple', lineendings='unix',
+                              itemids=','.join(map(str, jitemids)))
+
+    props = {}
+    for n in range(1, int(flat.get('prop_count', 0)) + 1):
+        props.setdefault(flat[f'prop_{n}_itemid'], {})[flat[f'prop_{n}_name']] = flat[f'prop_{n}_value']
+
+    events = []
+    for n in range(1, int(flat.get('events_count', 0)) + 1):
+        prefix = f'events_{n}_'
+        jitemid = flat[prefix + 'itemid']
+        item_props = props.get(jitemid, {})
+
+        events.append({
+            # export_do.bml's itemid is the public one, jitemid * 256 + anum
+            'itemid': str(int(jitemid) * 256 + int(flat.get(prefix + 'anum', 0))),
+            'eventtime': flat.get(prefix + 'eventtime', ''),
+            'logtime': flat.get(prefix + 'logtime', ''),
+            'subject': flat.get(prefix + 'subject', ''),
+            'event': unquote_plus(flat.get(prefix + 'event', '')),
+            'security': flat.get(prefix + 'security', 'public'),
+            'allowmask': flat.get(prefix + 'allowmask', '0'),
+            'current_music': item_props.get('current_music', ''),
+            'current_mood': item_props.get('current_mood', ''),
+        })
+
+    return events, size
+
+
+def merge_month_entries(posts_xml_filename, events):
+    """ Adds events to a month file of <entry> records, replacing those with the same itemid """
+    entries = {}
+
+    stored = rawstore.find_raw(posts_xml_filename)
+    if stored:
+        for e in iter_xml_elements(rawstore.read_raw(stored), 'entry'):
+            entries[e.findtext('itemid')] = {name: e.findtext(name) or '' for name in ENTRY_FIELDS}
+
+    entries.update((event['itemid'], event) for event in events)
+
+    root = etree.Element('livejournal')
+    for entry in sorted(entries.values(), key=lambda e: e['eventtime']):
+        entry_xml = etree.SubElement(root, 'entry')
+        for name in ENTRY_FIELDS:
+            etree.SubElement(entry_xml, name).text = XML_INVALID_CHARS.sub('', entry[name] or '')
+
+    rawstore.write_raw(posts_xml_filename, etree.tostring(root, encoding='utf-8', xml_declaration=True),
+                       RAW_COMPRESSION)
+
 # Comments
-@jitter()
-def fetch_xml(params):
+@delay()
+def fetch_xml(params, journal=None):
+    LJ_RATE_LIMIT.wait()
     response = requests.get(
         'http://www.livejournal.com/export_comments.bml',
-        params=params,
+        params={**params, **journal_params(journal)},
         headers=config.header,
         cookies=get_cookies()
     )
-    return response.text
-
 
-def update_users_map(root_xml, lj_user_dir):
-    incoming_users = {}
+    # Raising makes @delay try again, so an error page is never stored or read as comments
+    if response.status_code != requests.codes.ok:
+        raise IOError(f"HTTP {response.status_code} for {params}")
+    if etree.XML(response.content).tag != 'livejournal':
+        raise ValueError(f"No comments XML for {params}")
 
-    usermap_file = Path(lj_user_dir, 'comments_user_map.json')
+    return response.content
 
-    # Read in existing usermaps, if file exists
-    if usermap_file.is_file():
-        with open(usermap_file, 'r') as f:
-            existing_usermaps = json.load(f)
-    else:
-        existing_usermaps = {}
 
+def merge_users_map(root_xml, users_map):
     # Get user records
-    user_records = root_xml.xpath('.//usermap')
-    for r in user_records:
-        incoming_users[r.attrib['id']] = r.attrib['user']
+    for r in root_xml.xpath('.//usermap'):
+        users_map[r.attrib['id']] = r.attrib['user']
 
-    # Merge
-    updated_users = {**existing_usermaps, **incoming_users}
+    return users_map
 
-    # Write it out
-    with open(os.path.join(lj_user_dir, 'comments_user_map.json'), 'w') as f:
-        f.write(json.dumps(updated_users, ensure_ascii=False, indent=2))
 
-    return
+def write_json_atomic(filename, data):
+    # Write to a temp file alongside, then rename over, so readers never see a half-written file
+    tmp_filename = f'{filename}.tmp'
+    with open(tmp_filename, 'w') as f:
+        f.write(json.dumps(data, ensure_ascii=False, indent=2))
+
+    os.replace(tmp_filename, filename)
 
 
-def get_comment_property(name, comment_xml, comment):
+def get_comment_property(name, comment_xml):
     if name in comment_xml.attrib:
-        comment[name] = int(comment_xml.attrib[name])
+        return int(comment_xml.attrib[name])
 
+    return None
 
-def get_comment_element(name, comment_xml, comment):
+
+def get_comment_element(name, comment_xml):
     elements = comment_xml.findall(name)
     if len(elements) > 0:
-        comment[name] = elements[0].text
+        return elements[0].text
 
+    return None
 
-def get_more_comments(start_id, users, comments_xml_dir):
-    comments = []
-    local_max_id = -1
 
-    log.info(f"Fetching more comments, now at comment {str(start_id)}")
+def get_more_comments(start_id, users, comments_xml_dir, journal=None, reuse=False):
+    # An empty page still moves start_id on, so the caller's loop always ends
+    local_max_id = start_id
 
-    xml = fetch_xml({'get': 'comment_body', 'startid': start_id})
     comments_xml_filename = os.path.join(comments_xml_dir, 'comment_body-{0}.xml'.format(start_id))
-    with open(comments_xml_filename, 'w', encoding="utf8") as f:
-        f.write(xml)
-
-    for comment_xml in xml_element_tree.fromstring(xml).iter('comment'):
-        comment = {
-            'jitemid': int(comment_xml.attrib['jitemid']),
-            'id': int(comment_xml.attrib['id']),
-            'children': []
-        }
-        get_comment_property('parentid', comment_xml, comment)
-        get_comment_property('posterid', comment_xml, comment)
-        get_comment_element('date', comment_xml, comment)
-        get_comment_element('subject', comment_xml, comment)
-        get_comment_element('body', comment_xml, comment)
+    stored_file = reuse and rawstore.find_raw(comments_xml_filename)
 
-        if 'state' in comment_xml.attrib:
-            comment['state'] = comment_xml.attrib['state']
-
-        if 'posterid' in comment:
-            comment['author'] = users.get(str(comment['posterid']), "deleted-user")
+    # With reuse (plan.py's chunks), pages already on disk are read instead, so an interrupted chunked
+    # download picks up where it stopped; a normal export fetches them again to pick up edits and deletions
+    if stored_file:
+        log.debug(f"Reading stored comments, now at comment {str(start_id)}")
+        xml = rawstore.read_raw(stored_file)
+    else:
+        log.debug(f"Fetching more comments, now at comment {str(start_id)}")
+        xml = fetch_xml({'get': 'comment_body', 'startid': start_id}, journal=journal)
+        if xml is None:
+            raise RuntimeError(f"Could not download the comments from {start_id}")
+        rawstore.write_raw(comments_xml_filename, xml, RAW_COMPRESSION)
 
-        local_max_id = max(local_max_id, comment['id'])
-        comments.append(comment)
+    comments = extract_comments_from_xml(xml, users)
+    for comment in comments:
+        local_max_id = max(local_max_id, comment.id)
 
     return local_max_id, comments
 
 
 # Authentication
+SESSION_COOKIES = {}
+SESSION_LOCK = threading.Lock()
+
+
 def get_cookies():
+    # One ljsession serves every request of the run, including authas requests for communities
+    with SESSION_LOCK:
+        if not SESSION_COOKIES:
+            SESSION_COOKIES.update(generate_session())
+
+    return SESSION_COOKIES
+
+
+def generate_session():
+    LJ_RATE_LIMIT.wait()
     r1 = requests.post(config.lj_server + "/interface/flat", data={'mode': 'getchallenge'})
     r1_flat = flatten_string_pairs_to_dict(r1.text)
     challenge = r1_flat['challenge']
 
+    LJ_RATE_LIMIT.wait()
     r2 = requests.post(config.lj_server + "/interface/flat",
                        data={'mode': 'sessiongenerate',
                              'user': config.username,
@@ -722,8 +1227,9 @@ def get_cookies():
 
 
 def flatten_string_pairs_to_dict(response, delimiter='\n'):
-    items = response.strip(delimiter).split(delimiter)
-    flat_response = {items[i]: items[i + 1] for i in range(0, len(items), 2)}
+    # Values can be empty, so only the line break that ends the response is dropped
+    items = response.split(delimiter)
+    flat_response = {items[i]: items[i + 1] for i in range(0, len(items) - 1, 2)}
     return flat_response
 
 
@@ -748,6 +1254,5 @@ def setup_logging():
 
 if __name__ == '__main__':
     setup_logging()
-    log = logging.getLogger()
 
     main()
@@ -0,0 +1,147 @@
+"""
+A small on-disk HTTP cache that revalidates with conditional requests.
+
+For each URL the body is kept alongside a JSON record of its ETag, Last-Modified and expiry.  A fresh
+entry is served without touching the network; a stale one is revalidated with If-None-Match /
+If-Modified-Since, so unchanged resources cost a 304 rather than a full download.
+
+Callers that save the body themselves pass body_file instead, and only the record is kept here.
+"""
+
+import email.utils
+import json
+import os
+import re
+import time
+from hashlib import sha1
+from pathlib import Path
+
+import requests
+
+MAX_AGE = re.compile(r'max-age=(\d+)')
+
+
+class CachedResponse:
+    __slots__ = ('url', 'status_code', 'content', 'headers', 'from_cache', 'not_modified')
+
+    def __init__(self, url, status_code, content=None, headers=None, from_cache=False, not_modified=False):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        # from_cache: body came from disk.  not_modified: the server confirmed it with a 304.
+        self.from_cache = from_cache
+        self.not_modified = not_modified
+
+    @property
+    def ok(self):
+        return self.status_code == requests.codes.ok
+
+
+def cache_paths(cache_dir, url):
+    key = sha1(url.encode('utf-8')).hexdigest()
+    return Path(cache_dir, key + '.json'), Path(cache_dir, key + '.body')
+
+
+def expiry_from_headers(headers, now):
+    cache_control = headers.get('cache-control', '')
+    if 'no-cache' in cache_control or 'no-store' in cache_control:
+        return now
+
+    max_age = MAX_AGE.search(cache_control)
+    if max_age:
+        return now + int(max_age.group(1))
+
+    if headers.get('expires'):
+        try:
+            return email.utils.parsedate_to_datetime(headers['expires']).timestamp()
+        except (TypeError, ValueError):
+            pass
+
+    return now
+
+
+def read_entry(cache_dir, url, body_file):
+    meta_file, _ = cache_paths(cache_dir, url)
+    if not (meta_file.is_file() and body_file.is_file()):
+        return None
+
+    try:
+        with open(meta_file) as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        return None
+
+
+def write_entry(cache_dir, url, entry, content=None):
+    meta_file, body_file = cache_paths(cache_dir, url)
+
+    if content is not None:
+        with open(f'{body_file}.tmp', 'wb') as f:
+            f.write(content)
+        os.replace(f'{body_file}.tmp', body_file)
+
+    with open(f'{meta_file}.tmp', 'w') as f:
+        f.write(json.dumps(entry, indent=2))
+    os.replace(f'{meta_file}.tmp', meta_file)
+
+
+def get(url, cache_dir, revalidate=False, body_file=None, **kwargs):
+    """
+    GETs url through the cache in cache_dir.
+
+    An unexpired entry is returned as-is unless revalidate is set, in which case (as for expired
+    entries) the server is asked whether it changed.  Extra kwargs are passed on to requests.get.
+
+    body_file is where the caller keeps the body, if it does: the cache then stores no copy of its
+    own, reads that file for cached responses, and makes a plain request if it isn't there.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    now = time.time()
+
+    own_body = body_file is None
+    _, cache_body_file = cache_paths(cache_dir, url)
+    if own_body:
+        body_file = cache_body_file
+    elif cache_body_file.is_file():
+        # left from before the caller kept the body itself
+        os.remove(cache_body_file)
+
+    entry = read_entry(cache_dir, url, Path(body_file))
+
+    def cached(not_modified=False):
+        with open(body_file, 'rb') as f:
+            return CachedResponse(url, requests.codes.ok, f.read(), entry['headers'],
+                                  from_cache=True, not_modified=not_modified)
+
+    if entry and not revalidate and entry.get('expires', 0) > now:
+        return cached()
+
+    headers = dict(kwargs.pop('headers', None) or {})
+    if entry:
+        if entry['headers'].get('etag'):
+            headers['If-None-Match'] = entry['headers']['etag']
+        if entry['headers'].get('last-modified'):
+            headers['If-Modified-Since'] = entry['headers']['last-modified']
+
+    r = requests.get(url, headers=headers, **kwargs)
+
+    if r.status_code == requests.codes.not_modified and entry:
+        entry['expires'] = expiry_from_headers(r.headers, now)
+        entry['checked'] = now
+        write_entry(cache_dir, url, entry)
+        return cached(not_modified=True)
+
+    if r.status_code != requests.codes.ok:
+        return CachedResponse(url, r.status_code, r.content, dict(r.headers))
+
+    kept_headers = {k.lower(): v for k, v in r.headers.items()
+                    if k.lower() in ('etag', 'last-modified', 'content-type', 'cache-control', 'expires')}
+    write_entry(cache_dir, url, {
+        'url': url,
+        'headers': kept_headers,
+        'expires': expiry_from_headers(r.headers, now),
+        'checked': now
+    }, own_body and r.content or None)
+
+    return CachedResponse(url, r.status_code, r.content, kept_headers)
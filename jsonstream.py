@@ -0,0 +1,96 @@
+import json
+import os
+
+JSON_SUFFIXES = {
+    'json': '.json',
+    'jsonl': '.jsonl',
+}
+
+
+class RecordWriter:
+    """
+    Writes records to a file one at a time, either as a single JSON array or as JSON Lines.
+
+    Nothing but the current record is held in memory.  indent=None gives compact output; JSON Lines
+    output is always one compact record per line.
+    """
+
+    def __init__(self, f, fmt='json', indent=2):
+        if fmt not in JSON_SUFFIXES:
+            raise ValueError(f"Unknown JSON format '{fmt}', use one of {', '.join(JSON_SUFFIXES)}")
+
+        self.f = f
+        self.jsonl = fmt == 'jsonl'
+        self.indent = indent
+        self.count = 0
+
+        if not self.jsonl:
+            self.f.write('[')
+
+    def write(self, record):
+        if self.jsonl:
+            self.f.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')))
+            self.f.write('\n')
+        elif self.indent is None:
+            self.f.write(self.count and ',' or '')
+            self.f.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')))
+        else:
+            # Same layout as json.dumps(records, indent=...): JSON strings can't hold raw newlines,
+            # so indenting every line of the record is safe
+            pad = '\n' + ' ' * self.indent
+            self.f.write(self.count and ',' + pad or pad)
+            self.f.write(json.dumps(record, ensure_ascii=False, indent=self.indent).replace('\n', pad))
+
+        self.count += 1
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+
+    def close(self):
+        if not self.jsonl:
+            self.f.write(self.indent is not None and self.count and '\n]' or ']')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # A failed run isn't given a closing bracket, so it can't pass for a complete array
+        if exc_type is None:
+            self.close()
+        return False
+
+
+def records_filename(directory, name, fmt='json'):
+    """ e.g. all_posts.json or all_posts.jsonl """
+    return os.path.join(directory, name + JSON_SUFFIXES[fmt])
+
+
+def write_records(filename, records, fmt='json', indent=2):
+    """
+    Streams records to filename and returns how many were written.  They go to a temporary file
+    that replaces filename only once every record is written, so an error part way through (a bad
+    XML file, say) leaves the previous file in place rather than a truncated one.
+    """
+    tmp_filename = f'{filename}.tmp'
+    try:
+        with open(tmp_filename, 'w') as f, RecordWriter(f, fmt=fmt, indent=indent) as writer:
+            writer.write_all(records)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+    os.replace(tmp_filename, filename)
+    return writer.count
+
+
+def read_records(filename):
+    """ Yields the records of a .jsonl file line by line, or of a .json array file """
+    with open(filename, 'r') as f:
+        if filename.endswith(JSON_SUFFIXES['jsonl']):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from json.load(f)
+
@@ -11,3 +11,74 @@ end_date = "2018/07/31"
 header = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 8.1; rv:10.0) Gecko/20100101 Firefox/10.0'
 }
+
+# For bulk.py: journals and communities to export, all downloaded using the account above.
+# Communities need the account to be a maintainer.
+journals = [username]
+
+# Limits shared across every journal being exported
+bulk_max_workers = 4
+requests_per_second = 1
+
+# Raw XML downloads (posts_xml, comments_xml) can be stored compressed: None, 'gzip' or 'zstd'.
+# zstd needs the zstandard package.  Existing files are read whichever way they were stored.
+raw_compression = None
+
+# Set to True to add commenters who appeared since the usermap was first built
+extend_usermap = False
+
+# all_posts and all_comments are written as a JSON array ('json') or as JSON Lines ('jsonl').
+# json_indent = None writes compact JSON, which is smaller and faster.
+json_format = 'json'
+json_indent = 2
+
+# Build a full-text search index (search.sqlite, query it with search.py) while combining.
+# search_shards also writes it as static JSON files under posts_html/search for the generated site.
+search_index = True
+search_shards = False
+
+# Where posts come from: 'export' (export_do.bml, one request per month, even for empty months) or
+# 'flat' (the flat protocol: only entries that exist or changed since the last run, flat_batch_size
+# at most per request, fewer when that would go over about flat_batch_bytes)
+post_backend = 'export'
+flat_batch_size = 50
+flat_batch_bytes = 1000000
+
+# Commenters' userpics are all fetched before the posts are rendered, this many at a time
+userpic_max_workers = 2
+
+# Re-check friends' FOAF files and userpics with the server.  Unchanged ones cost a 304, not a download.
+refresh_userpics = False
+
+# Download images embedded in posts and comments into the media directory and link to those copies.
+# Copy the media directory to static/media on the site.
+archive_media = False
+media_max_workers = 8
+media_per_host = 2
+
+# Threads writing output files in the background while posts are rendered (0 to write inline)
+output_threads = 4
+
+# Write the whole rendered export into one archive instead of a file per post:
+# None, 'zip', 'tar', 'tar.gz', 'tar.bz2' or 'tar.xz'.  Extract a post with: python outwriter.py <archive> <post id>
+output_archive = None
+
+# Link comments to copies of the userpics resized to 100x100 and recompressed, 'webp' or 'png', instead
+# of the downloaded files (None).  Needs Pillow.  With userpic_sprites they're packed into sheets of up to
+# userpic_sprite_size pics, shown through userpic_assets/userpics.css.  Copy userpic_assets to
+# static/userpic_assets on the site.
+userpic_assets = None
+userpic_sprites = False
+userpic_sprite_size = 256
+
+# Show how far downloading and rendering have got, with items per second and time left
+show_progress = True
+
+# Posts per page on the generated posts_html/index.html pages
+index_page_size = 50
+
+# Also write post and comment metadata as numpy arrays (needs numpy), see analytics.py
+analytics_export = False
+
+# Requests per chunk when plan.py splits the remaining downloads into pieces to run one at a time
+plan_chunk_requests = 100
@@ -0,0 +1,215 @@
+"""
+Archives images embedded in post and comment bodies.
+
+Image URLs are pulled out of the bodies with lxml, deduplicated across the journal and downloaded
+concurrently, with a limit per host, into a content-addressed directory (media/ab/abcdef....jpg).
+media_manifest.json records what every URL resolved to, and failures, so reruns skip what's done
+and only retry what failed.  The rendered HTML and Markdown are then pointed at the local copies.
+"""
+
+import html
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from hashlib import sha256
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import requests
+from lxml import etree
+from lxml import html as lxml_html
+
+log = logging.getLogger(__name__)
+
+MEDIA_MANIFEST_FILE = 'media_manifest.json'
+
+MIME_EXTENSIONS = {
+    "image/gif": ".gif",
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/webp": ".webp",
+    "image/svg+xml": ".svg",
+    "image/bmp": ".bmp",
+}
+
+# Failed URLs are tried again on later runs, up to this many times in total
+MAX_ATTEMPTS = 3
+
+IMG_SRC = re.compile(r'''(<img\b[^>]*?\bsrc\s*=\s*)(["']?)([^"'\s>]+)\2''', re.IGNORECASE)
+
+
+def extract_image_urls(body):
+    if not body or '<img' not in body.lower():
+        return []
+
+    try:
+        fragment = lxml_html.fragment_fromstring(body, create_parent='div')
+    except (etree.ParserError, ValueError):
+        return []
+
+    urls = []
+    for img in fragment.iter('img'):
+        src = (img.get('src') or '').strip()
+        if src.startswith(('http://', 'https://')):
+            urls.append(src)
+
+    return urls
+
+
+def collect_image_urls(posts, comments):
+    """ Distinct image URLs across all post and comment bodies, in the order first seen """
+    urls = {}
+
+    for post in posts:
+        urls.update(dict.fromkeys(extract_image_urls(post.get('body'))))
+
+    for comment in comments:
+        urls.update(dict.fromkeys(extract_image_urls(comment.body)))
+
+    return list(urls)
+
+
+def read_manifest(manifest_file):
+    if not os.path.isfile(manifest_file):
+        return {}
+
+    try:
+        with open(manifest_file) as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        return {}
+
+
+def write_manifest(manifest_file, manifest):
+    with open(f'{manifest_file}.tmp', 'w') as f:
+        f.write(json.dumps(manifest, ensure_ascii=False, indent=2))
+
+    os.replace(f'{manifest_file}.tmp', manifest_file)
+
+
+def needs_fetch(entry):
+    if entry is None:
+        return True
+
+    return entry['status'] != 'ok' and entry.get('attempts', 0) < MAX_ATTEMPTS
+
+
+class HostLimits:
+    """ A semaphore per host, so no single server gets more than `per_host` requests at once """
+
+    def __init__(self, per_host):
+        self.per_host = per_host
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    def __call__(self, url):
+        host = urlsplit(url).hostname or ''
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            return self.semaphores[host]
+
+
+def fetch_image(url, media_dir, host_limits, headers=None, timeout=30):
+    """ Downloads one image into the content-addressed media_dir, returning its manifest entry """
+    try:
+        with host_limits(url):
+            r = requests.get(url, headers=headers, timeout=timeout)
+    except requests.RequestException as e:
+        return {'status': 'error', 'error': str(e)}
+
+    if r.status_code != requests.codes.ok:
+        return {'status': 'error', 'error': f'HTTP {r.status_code}'}
+
+    content_type = r.headers.get('content-type', '').split(';')[0].strip().lower()
+    if not content_type.startswith('image/'):
+        return {'status': 'error', 'error': f'not an image ({content_type or "no content type"})'}
+
+    digest = sha256(r.content).hexdigest()
+    ext = MIME_EXTENSIONS.get(content_type) or os.path.splitext(urlsplit(url).path)[1].lower() or '.bin'
+    relative_file = f'{digest[:2]}/{digest}{ext}'
+
+    # Two URLs can serve the same bytes at the same time, so each download gets its own temporary file
+    save_file = Path(media_dir, relative_file)
+    if not save_file.is_file():
+        try:
+            os.makedirs(save_file.parent, exist_ok=True)
+            fd, tmp_file = tempfile.mkstemp(dir=save_file.parent, prefix=digest[:8], suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(r.content)
+                # mkstemp makes it private; the archive is for serving
+                os.chmod(tmp_file, 0o644)
+                os.replace(tmp_file, save_file)
+            except OSError:
+                os.remove(tmp_file)
+                raise
+        except OSError as e:
+            return {'status': 'error', 'error': f'could not save: {e}'}
+
+    return {'status': 'ok', 'file': relative_file, 'bytes': len(r.content)}
+
+
+def archive_images(urls, media_dir, manifest_file, max_workers=8, per_host=2, headers=None):
+    """ Makes sure every URL has been tried, returning the manifest (url -> entry) """
+    manifest = read_manifest(manifest_file)
+    todo = [url for url in urls if needs_fetch(manifest.get(url))]
+
+    log.info(f"Embedded images: {len(urls)} found, {len(todo)} to download")
+    if not todo:
+        return manifest
+
+    host_limits = HostLimits(per_host)
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='media') as pool:
+        futures = {pool.submit(fetch_image, url, media_dir, host_limits, headers): url for url in todo}
+
+        for done, future in enumerate(as_completed(futures), 1):
+            url = futures[future]
+            entry = future.result()
+            entry['attempts'] = manifest.get(url, {}).get('attempts', 0) + 1
+            entry['checked'] = time.time()
+            manifest[url] = entry
+
+            if entry['status'] != 'ok':
+                log.info(f"  Could not archive {url}: {entry['error']}")
+
+            if done % 100 == 0:
+                write_manifest(manifest_file, manifest)
+
+    write_manifest(manifest_file, manifest)
+    return manifest
+
+
+def local_urls(manifest, static_prefix):
+    """ url -> site path for every archived image """
+    return {url: f'/{static_prefix}/{entry["file"]}' for url, entry in manifest.items() if entry['status'] == 'ok'}
+
+
+def rewrite_image_urls(body, url_map):
+    """ Points <img src> at the archived copies, leaving the rest of the markup untouched """
+    if not body or not url_map:
+        return body
+
+    def replace(m):
+        local = url_map.get(html.unescape(m.group(3)))
+        if local is None:
+            return m.group(0)
+        quote = m.group(2) or '"'
+        return f'{m.group(1)}{quote}{local}{quote}'
+
+    return IMG_SRC.sub(replace, body)
+
+
+def archive_embedded_media(posts, comments, media_dir, manifest_file, static_prefix, **kwargs):
+    """
+    The embedded media stage: downloads the images in posts and comments, and returns the url -> local
+    path map for rewrite_image_urls.  The bodies themselves keep the original URLs; only the rendered
+    HTML and Markdown point at the local copies.
+    """
+    manifest = archive_images(collect_image_urls(posts, comments), media_dir, manifest_file, **kwargs)
+    return local_urls(manifest, static_prefix)
@@ -0,0 +1,304 @@
+"""
+Writes the rendered output files of an export.
+
+- directories are created once and remembered, not makedirs'd for every file
+- files are written to a temp file and renamed into place, so an interrupted run never leaves a
+  truncated file behind
+- a file whose content hasn't changed since the last run isn't written at all (hashes are kept in
+  a manifest at the top of the output)
+- with threads > 0 the writes happen on a background pool, so rendering doesn't wait on the disk
+
+ArchiveWriter has the same interface but streams everything into one zip or tar file instead, with
+a JSON index next to it for pulling single posts back out.
+
+    python outwriter.py exported_journals/<username>/export.zip <post id>
+"""
+
+import io
+import json
+import os
+import sys
+import tarfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+
+OUTPUT_MANIFEST_FILE = 'output_hashes.json'
+
+ARCHIVE_FORMATS = {
+    'zip': None,
+    'tar': 'w',
+    'tar.gz': 'w:gz',
+    'tar.bz2': 'w:bz2',
+    'tar.xz': 'w:xz',
+}
+
+
+class OutputWriter:
+    def __init__(self, top_dir, threads=0, max_pending=256):
+        self.top_dir = top_dir
+        self.lock = threading.Lock()
+        self.created_dirs = set()
+        self.manifest_file = os.path.join(top_dir, OUTPUT_MANIFEST_FILE)
+        self.hashes = self.read_manifest()
+        self.written = 0
+        self.unchanged = 0
+
+        self.pool = threads and ThreadPoolExecutor(max_workers=threads, thread_name_prefix='writer') or None
+        self.errors = []
+        # Caps how many rendered files can be waiting in memory for the pool
+        self.slots = threading.BoundedSemaphore(max_pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def read_manifest(self):
+        if not os.path.isfile(self.manifest_file):
+            return {}
+
+        try:
+            with open(self.manifest_file) as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            return {}
+
+    def write(self, relative_path, content, key=None):
+        """
+        Writes content to relative_path under the top directory; key is only used by archives.  content
+        is str or bytes, or an iterable of str parts, which is hashed and written as it's consumed
+        rather than held whole in memory
+        """
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+
+        if self.pool is None:
+            self._write(relative_path, content)
+            return
+
+        self.slots.acquire()
+        self.pool.submit(self._write, relative_path, content).add_done_callback(self._done)
+
+    def _done(self, future):
+        self.slots.release()
+        if future.exception() is not None:
+            with self.lock:
+                self.errors.append(future.exception())
+
+    def _write(self, relative_path, content):
+        filename = os.path.join(self.top_dir, relative_path)
+        tmp_filename = f'{filename}.tmp'
+
+        if isinstance(content, bytes):
+            digest = sha1(content).hexdigest()
+            if self.is_unchanged(relative_path, filename, digest):
+                self.count_unchanged(relative_path, digest)
+                return
+
+            self.ensure_dir(os.path.dirname(filename))
+            with open(tmp_filename, 'wb') as f:
+                f.write(content)
+        else:
+            # The digest is only known at the end, so an unchanged file is found after writing the temp file
+            self.ensure_dir(os.path.dirname(filename))
+            digest = self.write_parts(tmp_filename, content)
+            if self.is_unchanged(relative_path, filename, digest):
+                os.remove(tmp_filename)
+                self.count_unchanged(relative_path, digest)
+                return
+
+        os.replace(tmp_filename, filename)
+
+        with self.lock:
+            self.hashes[relative_path] = digest
+            self.written += 1
+
+    @staticmethod
+    def write_parts(tmp_filename, parts):
+        """ Writes the str parts to tmp_filename and returns their SHA-1 """
+        digest = sha1()
+        try:
+            with open(tmp_filename, 'wb') as f:
+                for part in parts:
+                    part = part.encode('utf-8')
+                    digest.update(part)
+                    f.write(part)
+        except BaseException:
+            os.remove(tmp_filename)
+            raise
+
+        return digest.hexdigest()
+
+    def count_unchanged(self, relative_path, digest):
+        with self.lock:
+            self.hashes[relative_path] = digest
+            self.unchanged += 1
+
+    def is_unchanged(self, relative_path, filename, digest):
+        with self.lock:
+            known = self.hashes.get(relative_path)
+
+        if known is not None:
+            return known == digest and os.path.isfile(filename)
+
+        # Not in the manifest (e.g. first run with one): compare with what's on disk
+        if os.path.isfile(filename):
+            with open(filename, 'rb') as f:
+                return sha1(f.read()).hexdigest() == digest
+
+        return False
+
+    def ensure_dir(self, directory):
+        if directory in self.created_dirs:
+            return
+
+        os.makedirs(directory, exist_ok=True)
+        with self.lock:
+            self.created_dirs.add(directory)
+
+    def close(self):
+        """ Waits for pending writes, saves the manifest, and re-raises the first failed write """
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+            if self.errors:
+                self.save_manifest()
+                raise self.errors[0]
+
+        self.save_manifest()
+
+    def save_manifest(self):
+        tmp_filename = f'{self.manifest_file}.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.hashes, f, indent=0, sort_keys=True)
+        os.replace(tmp_filename, self.manifest_file)
+
+
+class ArchiveWriter:
+    """
+    Streams output files into a single zip or tar archive, nothing is written per file on disk.
+
+    The index (archive name + '.index.json') maps every member to its data offset and size, and each
+    key passed to write() (a post id) to its members.  For zip and uncompressed tar that allows
+    reading one post straight out of the archive; compressed tars can only be read sequentially.
+    """
+
+    def __init__(self, archive_file, fmt='zip'):
+        if fmt not in ARCHIVE_FORMATS:
+            raise ValueError(f"Unknown archive format '{fmt}', use one of {', '.join(ARCHIVE_FORMATS)}")
+
+        self.archive_file = archive_file
+        self.index_file = archive_file + '.index.json'
+        self.fmt = fmt
+        self.written = 0
+        self.unchanged = 0
+        self.index = {'format': fmt, 'members': {}, 'keys': {}}
+
+        if fmt == 'zip':
+            self.archive = zipfile.ZipFile(archive_file + '.tmp', 'w', compression=zipfile.ZIP_DEFLATED)
+        else:
+            self.archive = tarfile.open(archive_file + '.tmp', ARCHIVE_FORMATS[fmt])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def write(self, relative_path, content, key=None):
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+
+        elif not isinstance(content, bytes):
+            content = ''.join(content).encode('utf-8')
+
+        name = relative_path.replace(os.sep, '/')
+
+        if self.fmt == 'zip':
+            self.archive.writestr(name, content)
+            self.index['members'][name] = [None, len(content)]
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mtime = int(time.time())
+            self.archive.addfile(info, io.BytesIO(content))
+
+            # The data sits just before the current end of the archive, padded to whole tar blocks
+            data_offset = self.archive.offset - -(-len(content) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            self.index['members'][name] = [data_offset if self.fmt == 'tar' else None, len(content)]
+
+        if key is not None:
+            self.index['keys'].setdefault(str(key), []).append(name)
+
+        self.written += 1
+
+    def add_directory(self, directory, arc_dir):
+        """ Adds files already on disk, such as userpics, under arc_dir """
+        for path, dirlist, filelist in os.walk(directory):
+            for filename in sorted(filelist):
+                full_path = os.path.join(path, filename)
+                with open(full_path, 'rb') as f:
+                    self.write(os.path.join(arc_dir, os.path.relpath(full_path, directory)), f.read())
+
+    def close(self):
+        self.archive.close()
+        os.replace(self.archive_file + '.tmp', self.archive_file)
+
+        with open(self.index_file, 'w') as f:
+            json.dump(self.index, f, ensure_ascii=False, separators=(',', ':'))
+
+
+def read_archive_index(archive_file):
+    with open(archive_file + '.index.json') as f:
+        return json.load(f)
+
+
+def read_from_archive(archive_file, names, index=None):
+    """ Reads members of an archive written by ArchiveWriter, seeking directly to them where possible """
+    index = index or read_archive_index(archive_file)
+    rv = {}
+
+    if index['format'] == 'zip':
+        with zipfile.ZipFile(archive_file) as z:
+            for name in names:
+                rv[name] = z.read(name)
+
+    elif index['format'] == 'tar':
+        with open(archive_file, 'rb') as f:
+            for name in names:
+                offset, size = index['members'][name]
+                f.seek(offset)
+                rv[name] = f.read(size)
+
+    else:
+        wanted = set(names)
+        with tarfile.open(archive_file) as t:
+            for member in t:
+                if member.name in wanted:
+                    rv[member.name] = t.extractfile(member).read()
+
+    return rv
+
+
+def read_post(archive_file, post_id):
+    """ All files (JSON, HTML, Markdown) written for one post, as {member name: bytes} """
+    index = read_archive_index(archive_file)
+    return read_from_archive(archive_file, index['keys'].get(str(post_id), []), index)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print(f"usage: {sys.argv[0]} <archive> <post id>")
+        sys.exit(1)
+
+    for member_name, data in read_post(sys.argv[1], sys.argv[2]).items():
+        os.makedirs(os.path.dirname(member_name) or '.', exist_ok=True)
+        with open(member_name, 'wb') as out:
+            out.write(data)
+        print(member_name)
@@ -0,0 +1,183 @@
+"""
+Index, archive and tag pages for the HTML export.
+
+combine() hands every post to a SiteAggregator as it goes, which keeps only what the listing pages
+need (title, filing time, path, counts, tags, commenters).  write_pages() then emits all of them in one go,
+without reading back any of the files already written.
+
+    posts_html/index.html, index-2.html, ...    newest first, with per-year counts and top commenters
+    posts_html/YYYY/index.html                   a year, by month
+    posts_html/YYYY/MM/index.html                a month
+    posts_html/tags/index.html, tags/<tag>.html  tags, from the UTX tags in the posts
+"""
+
+import os
+import posixpath
+import re
+from collections import Counter
+
+import timestamps
+
+PAGE_TEMPLATE = """<!doctype html>
+<meta charset="utf-8">
+<title>{title}</title>
+<article>
+<h1>{title}</h1>
+{body}
+</article>
+"""
+
+NOT_WORDS = re.compile(r'\W+')
+
+MONTH_NAMES = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September',
+               'October', 'November', 'December']
+
+
+class PostSummary:
+    __slots__ = ('id', 'title', 'epoch', 'year', 'month', 'path', 'comments', 'tags')
+
+    def __init__(self, id, title, epoch, year, month, path, comments, tags):
+        self.id = id
+        self.title = title
+        self.epoch = epoch
+        self.year = year
+        self.month = month
+        self.path = path
+        self.comments = comments
+        self.tags = tags
+
+
+def tag_slugs(tags):
+    """ {tag: slug} for tags, where a slug already taken (e.g. 'c' for both 'C' and 'C++') gets a number added """
+    slugs = {}
+    taken = {'index'}
+    for tag in sorted(tags):
+        slug = base = NOT_WORDS.sub('-', tag.lower()).strip('-') or 'tag'
+        n = 1
+        while slug in taken:
+            n += 1
+            slug = f'{base}-{n}'
+
+        taken.add(slug)
+        slugs[tag] = slug
+
+    return slugs
+
+
+class SiteAggregator:
+    def __init__(self, html_dir='posts_html', per_page=50, top_commenters=20):
+        self.html_dir = html_dir
+        self.per_page = per_page
+        self.top_commenters = top_commenters
+        self.posts = []
+        self.commenters = Counter()
+
+    def add_post(self, json_post, subfolder, epoch, thread=None, tags=()):
+        """ epoch is the time the post was filed by (into subfolder), which the listings sort and show """
+        comments = 0
+        if thread is not None:
+            # Replies under a deleted comment aren't shown, so they aren't counted either
+            for i, level, entering in thread.walk(skip=lambda c: c.deleted):
+                if entering:
+                    comments += 1
+                    self.commenters[thread.comments[i].author or 'anonymous'] += 1
+
+        year, month = subfolder.split(os.sep)
+        self.posts.append(PostSummary(
+            id=json_post['id'],
+            title=json_post.get('subject') or json_post['date'],
+            epoch=epoch,
+            year=year,
+            month=month,
+            path=posixpath.join(year, month, json_post['id'] + '.html'),
+            comments=comments,
+            tags=list(tags)
+        ))
+
+    def write_pages(self, writer):
+        """ Writes every listing page through writer (an outwriter.OutputWriter or ArchiveWriter) """
+        posts = sorted(self.posts, key=lambda p: p.epoch, reverse=True)
+
+        by_year = {}
+        by_month = {}
+        by_tag = {}
+        for post in posts:
+            by_year.setdefault(post.year, []).append(post)
+            by_month.setdefault((post.year, post.month), []).append(post)
+            for tag in post.tags:
+                by_tag.setdefault(tag, []).append(post)
+
+        self.write_index(writer, posts, by_year)
+
+        for year, year_posts in by_year.items():
+            months = [(month, by_month[(y, month)]) for (y, month) in sorted(by_month, reverse=True) if y == year]
+            body = '\n'.join(
+                '<h2><a href="{0}/index.html">{1} {2}</a> ({3} posts)</h2>\n{4}'.format(
+                    month, MONTH_NAMES[int(month) - 1], year, len(month_posts),
+                    self.post_list(month_posts, posixpath.join(year, 'index.html')))
+                for month, month_posts in months)
+            self.write_page(writer, posixpath.join(year, 'index.html'), year, body)
+
+        for (year, month), month_posts in by_month.items():
+            page = posixpath.join(year, month, 'index.html')
+            self.write_page(writer, page, f'{MONTH_NAMES[int(month) - 1]} {year}',
+                            self.post_list(month_posts, page))
+
+        slugs = tag_slugs(by_tag)
+        tag_items = []
+        for tag, tag_posts in sorted(by_tag.items(), key=lambda t: (-len(t[1]), t[0].lower())):
+            page = posixpath.join('tags', slugs[tag] + '.html')
+            self.write_page(writer, page, f'Tag: {tag}', self.post_list(tag_posts, page))
+            tag_items.append('<li><a href="{0}.html">{1}</a> ({2})</li>'.format(slugs[tag], tag, len(tag_posts)))
+
+        if tag_items:
+            self.write_page(writer, posixpath.join('tags', 'index.html'), 'Tags',
+                            '<ul>\n{0}\n</ul>'.format('\n'.join(tag_items)))
+
+    def write_index(self, writer, posts, by_year):
+        num_pages = max(1, -(-len(posts) // self.per_page))
+
+        years = '<ul>\n{0}\n</ul>'.format('\n'.join(
+            '<li><a href="{0}/index.html">{0}</a>: {1} posts, {2} comments</li>'.format(
+                year, len(year_posts), sum(p.comments for p in year_posts))
+            for year, year_posts in sorted(by_year.items(), reverse=True)))
+
+        commenters = '<ol>\n{0}\n</ol>'.format('\n'.join(
+            '<li>{0} ({1})</li>'.format(name, count) for name, count in self.commenters.most_common(self.top_commenters)))
+
+        for n in range(num_pages):
+            page = n and f'index-{n + 1}.html' or 'index.html'
+            chunk = posts[n * self.per_page:(n + 1) * self.per_page]
+
+            body = self.post_list(chunk, page)
+
+            nav = []
+            if n > 0:
+                nav.append('<a href="{0}">Newer</a>'.format(n > 1 and f'index-{n}.html' or 'index.html'))
+            if n + 1 < num_pages:
+                nav.append('<a href="index-{0}.html">Older</a>'.format(n + 2))
+            if nav:
+                body += '\n<nav>{0}</nav>'.format(' | '.join(nav))
+
+            if n == 0:
+                body += '\n<h2>Archive</h2>\n' + years
+                if self.commenters:
+                    body += '\n<h2>Top commenters</h2>\n' + commenters
+                if any(p.tags for p in posts):
+                    body += '\n<p><a href="tags/index.html">Tags</a></p>'
+
+            title = n and f'All posts, page {n + 1} of {num_pages}' or 'All posts'
+            self.write_page(writer, page, title, body)
+
+    def post_list(self, posts, page):
+        page_dir = posixpath.dirname(page)
+        items = []
+        for post in posts:
+            href = posixpath.relpath(post.path, page_dir or '.')
+            comments = post.comments and f' ({post.comments} comments)' or ''
+            items.append(f'<li>{timestamps.iso(post.epoch)[:10]} <a href="{href}">{post.title}</a>{comments}</li>')
+
+        return '<ul>\n{0}\n</ul>'.format('\n'.join(items))
+
+    def write_page(self, writer, page, title, body):
+        writer.write(posixpath.join(self.html_dir, page), PAGE_TEMPLATE.format(title=title, body=body))
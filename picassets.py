@@ -0,0 +1,170 @@
+"""
+Userpics prepared for the generated site.
+
+Every pic is resized to 100x100 and recompressed as WebP or PNG, and optionally packed into sprite
+sheets with a CSS class per pic, so a busy comment page loads a few sheets rather than an image per
+commenter.  Written to exported_journals/<username>/userpic_assets/:
+
+    <hash>.webp         one per distinct downloaded pic, named by its content, so reruns skip it
+    sprite-N.webp       with sprites: up to sprite_size pics each, busiest commenters first
+    userpics.css        with sprites: .lj-userpic, and .up-N giving each pic's sheet and position
+
+Pillow is only needed for this module.
+"""
+
+import hashlib
+import io
+import logging
+import math
+import os
+from pathlib import Path
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+log = logging.getLogger(__name__)
+
+USERPIC_SIZE = 100
+
+ASSET_FORMATS = {
+    'webp': {'format': 'WEBP', 'quality': 85, 'method': 6},
+    'png': {'format': 'PNG', 'optimize': True},
+}
+
+STYLESHEET_FILE = 'userpics.css'
+
+STYLESHEET_BASE = ('.lj-userpic{{display:inline-block;width:{0}px;height:{0}px;'
+                   'background-repeat:no-repeat}}\n').format(USERPIC_SIZE)
+
+
+def ensure_pillow():
+    if Image is None:
+        raise RuntimeError("The userpic assets need Pillow: pip install Pillow")
+
+
+def normalize(src_file):
+    """ The first frame of a pic, scaled to fit USERPIC_SIZE square and centred on a transparent background """
+    with Image.open(src_file) as im:
+        im.seek(0)
+        im = im.convert('RGBA')
+
+    return ImageOps.pad(im, (USERPIC_SIZE, USERPIC_SIZE), method=Image.LANCZOS, color=(0, 0, 0, 0))
+
+
+def encode(image, fmt):
+    buf = io.BytesIO()
+    image.save(buf, **ASSET_FORMATS[fmt])
+    return buf.getvalue()
+
+
+def write_if_changed(path, data):
+    if path.is_file() and path.stat().st_size == len(data) and path.read_bytes() == data:
+        return
+
+    tmp_path = path.with_name(path.name + '.tmp')
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+
+def make_asset(src_file, out_dir, fmt):
+    """ Filename of src_file's optimized copy in out_dir, made if it isn't there yet """
+    data = src_file.read_bytes()
+    asset_file = Path(out_dir, f'{hashlib.sha1(data).hexdigest()[:20]}.{fmt}')
+
+    if not asset_file.is_file():
+        write_if_changed(asset_file, encode(normalize(src_file), fmt))
+
+    return asset_file.name
+
+
+def build_assets(userpic_files, src_dir, out_dir, fmt='webp', sprites=False, sprite_size=256, order=()):
+    """
+    Makes the optimized pics for userpic_files (username -> downloaded file in src_dir), and returns
+    {username: asset}, where an asset is {'file': name} or, with sprites, {'sheet': name, 'class': name}.
+    Users whose pic is missing or unreadable are left out, to be shown with the downloaded file.
+
+    order lists usernames to put first in the sprite sheets, such as the busiest commenters.
+    """
+    ensure_pillow()
+    if fmt not in ASSET_FORMATS:
+        raise ValueError(f"Unknown userpic asset format '{fmt}', use one of {', '.join(ASSET_FORMATS)}")
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    # Many users share a pic (the default one, at least), so each distinct file is only done once
+    asset_of_file = {}
+    assets = {}
+    for username in list(dict.fromkeys([*order, *sorted(userpic_files)])):
+        filename = userpic_files.get(username)
+        if not filename:
+            continue
+
+        if filename not in asset_of_file:
+            src_file = Path(src_dir, filename)
+            try:
+                asset_of_file[filename] = src_file.is_file() and make_asset(src_file, out_dir, fmt) or None
+            except (OSError, ValueError) as e:
+                log.warning(f"Could not optimize userpic {filename}: {e}")
+                asset_of_file[filename] = None
+
+        if asset_of_file[filename]:
+            assets[username] = {'file': asset_of_file[filename]}
+
+    if sprites:
+        assets = pack_sprites(assets, out_dir, fmt, sprite_size)
+
+    log.info(f"Userpic assets: {len(set(a.get('file') or a.get('class') for a in assets.values()))} pics "
+             f"for {len(assets)} users")
+
+    return assets
+
+
+def pack_sprites(assets, out_dir, fmt, sprite_size):
+    """ Packs the asset files, in the order of assets, into sheets of up to sprite_size, and writes the CSS """
+    files = list(dict.fromkeys(a['file'] for a in assets.values()))
+    columns = math.ceil(math.sqrt(sprite_size))
+
+    css = [STYLESHEET_BASE]
+    position = {}
+    sheets = 0
+
+    for sheet_start in range(0, len(files), sprite_size):
+        sheet_files = files[sheet_start:sheet_start + sprite_size]
+        sheet_name = f'sprite-{sheets}.{fmt}'
+        rows = math.ceil(len(sheet_files) / columns)
+        sheet = Image.new('RGBA', (min(len(sheet_files), columns) * USERPIC_SIZE, rows * USERPIC_SIZE), (0, 0, 0, 0))
+
+        for i, filename in enumerate(sheet_files):
+            x, y = i % columns * USERPIC_SIZE, i // columns * USERPIC_SIZE
+            with Image.open(Path(out_dir, filename)) as im:
+                sheet.paste(im.convert('RGBA'), (x, y))
+
+            css_class = f'up-{sheet_start + i}'
+            position[filename] = {'sheet': sheet_name, 'class': css_class}
+            css.append(f'.{css_class}{{background-image:url({sheet_name});background-position:-{x}px -{y}px}}\n')
+
+        write_if_changed(Path(out_dir, sheet_name), encode(sheet, fmt))
+        sheets += 1
+
+    # Sheets left from a run with more pics
+    for stale in Path(out_dir).glob(f'sprite-*.{fmt}'):
+        if int(stale.stem.split('-')[1]) >= sheets:
+            stale.unlink()
+
+    write_if_changed(Path(out_dir, STYLESHEET_FILE), ''.join(css).encode('utf-8'))
+
+    return {username: position[a['file']] for username, a in assets.items()}
+
+
+def markup(asset, static_prefix, username=''):
+    """ The HTML that shows an asset, with static_prefix the site path of the assets directory """
+    if 'class' in asset:
+        return f'<span class="lj-userpic {asset["class"]}" role="img" aria-label="{username}"></span>\n'
+
+    return f'<img src="/{static_prefix}/{asset["file"]}" width="{USERPIC_SIZE}" height="{USERPIC_SIZE}">\n'
+
+
+def stylesheet_link(static_prefix):
+    return f'<link rel="stylesheet" href="/{static_prefix}/{STYLESHEET_FILE}">\n'
@@ -0,0 +1,345 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Dry run for an export: how many requests it will make, how much is on disk already, and roughly how
+many bytes and how long the rest will take under the configured rate limits.
+
+Nothing is downloaded.  The estimate is built from ljconfig's date range, the comment maxid in
+comment_meta-0.xml, the friend list in the FOAF file and the files already on disk; where one of
+those isn't there yet, the plan says so and counts the request needed to find out.
+
+The remaining work is split into chunks of about plan_chunk_requests requests each, saved to
+exported_journals/<journal>/export_plan.json, which can be run one at a time, e.g. off-peak:
+
+    python plan.py [journal]              print the plan and save it
+    python plan.py journal --chunk 3      download chunk 3 of the saved plan
+"""
+
+import json
+import math
+import os
+import sys
+from pathlib import Path
+
+from lxml import etree
+
+import export
+import ljconfig as config
+import rawstore
+import timestamps
+import userpics
+
+PLAN_FILE = 'export_plan.json'
+
+# Most items LJ returns per request of each kind
+COMMENT_META_PAGE_SIZE = 10000
+COMMENT_BODY_PAGE_SIZE = 1000
+
+# Used for bytes estimates when nothing of that kind has been downloaded yet
+DEFAULT_BYTES = {
+    'session': 200,
+    'posts': 60000,
+    'comment_meta': 400000,
+    'comment_body': 600000,
+    'friend_userpics': 12000,
+    'commenter_userpics': 32000,
+}
+
+# Typical round trip, added to every request on top of the rate limits and sleeps
+DEFAULT_LATENCY = 0.5
+
+# Seconds userpics.py sleeps after each request of these kinds: a pic, or an FOAF file and a pic
+USERPIC_SLEEPS = {
+    'friend_userpics': 1,
+    'commenter_userpics': 2,
+}
+
+FOAF_NS = {'foaf': 'http://xmlns.com/foaf/0.1/'}
+
+
+def average_size(files, default):
+    sizes = [os.path.getsize(f) for f in files]
+    return sum(sizes) / len(sizes) if sizes else default
+
+
+def endpoint(total, cached, requests_per_item, item_bytes, seconds_per_request, **extra):
+    remaining = max(total - cached, 0)
+    rv = {
+        'total': total,
+        'cached': cached,
+        'remaining': remaining,
+        'requests': remaining * requests_per_item,
+        'bytes': int(remaining * item_bytes),
+        'seconds': remaining * requests_per_item * seconds_per_request,
+    }
+    rv.update(extra)
+    return rv
+
+
+def read_maxid(comments_xml_dir):
+    stored = rawstore.find_raw(Path(comments_xml_dir, 'comment_meta-0.xml'))
+    if not stored:
+        return None
+
+    return int(etree.XML(rawstore.read_raw(stored)).findtext('maxid'))
+
+
+def stored_start_ids(comments_xml_dir, prefix):
+    rv = []
+    for f in export.find_files_by_pattern(f'{prefix}-*.xml', comments_xml_dir):
+        start = os.path.basename(f)[len(prefix) + 1:].split('.')[0]
+        if start.isdigit():
+            rv.append(int(start))
+
+    return sorted(rv)
+
+
+def missing_id_ranges(max_id, stored_starts, page_size):
+    """ Comment id ranges not covered by the stored pages, taking each page as page_size ids """
+    ranges = []
+    next_id = 0
+
+    for start in stored_starts:
+        if start > next_id:
+            ranges.append((next_id, start - 1))
+        next_id = max(next_id, start + page_size)
+
+    if next_id <= max_id:
+        ranges.append((next_id, max_id))
+
+    return ranges
+
+
+def friend_nicks(journal):
+    rdf_file = Path(userpics.userpic_dirs['rdfs'], journal + '.rdf')
+    if not rdf_file.is_file():
+        return None
+
+    with open(rdf_file, 'rb') as f:
+        root = etree.XML(f.read())
+
+    return [n.text for n in root.xpath('//foaf:Person/foaf:nick', namespaces=FOAF_NS) if n.text]
+
+
+def has_local_userpic(username):
+    return userpics.userpics_meta.get(username, {}).get('state') == 'local'
+
+
+def make_plan(journal, top_dir=export.DOWNLOADED_JOURNALS_DIR, chunk_requests=None):
+    if chunk_requests is None:
+        chunk_requests = getattr(config, 'plan_chunk_requests', 100)
+
+    lj_user_dir = os.path.join(top_dir, journal)
+    posts_xml_dir = os.path.join(lj_user_dir, 'posts_xml')
+    comments_xml_dir = os.path.join(lj_user_dir, 'comments_xml')
+
+    rate = getattr(config, 'requests_per_second', 1)
+    lj_seconds = max(rate and 1 / rate or 0, DEFAULT_LATENCY)
+    notes = []
+    endpoints = {}
+
+    # Logging in, done once per run
+    endpoints['session'] = endpoint(1, 0, 2, DEFAULT_BYTES['session'], lj_seconds)
+
+    # Posts: one request per month
+    months = timestamps.month_range(config.start_date, config.end_date)
+    missing_months = [m for m in months if not rawstore.find_raw(Path(posts_xml_dir, f'{m[0]}-{m[1]:02d}.xml'))]
+    post_files = list(export.find_files_by_pattern('*.xml', posts_xml_dir)) if os.path.isdir(posts_xml_dir) else []
+    endpoints['posts'] = endpoint(len(months), len(months) - len(missing_months), 1,
+                                  average_size(post_files, DEFAULT_BYTES['posts']), lj_seconds)
+    if export.POST_BACKEND == 'flat':
+        notes.append("With post_backend = 'flat', posts are synced in batches rather than by month, "
+                     "so one request per month is an upper bound, and they're one chunk")
+
+    # Comments: metadata pages for the usermap, then body pages
+    max_id = read_maxid(comments_xml_dir) if os.path.isdir(comments_xml_dir) else None
+    meta_starts = stored_start_ids(comments_xml_dir, 'comment_meta') if max_id is not None else []
+    body_starts = stored_start_ids(comments_xml_dir, 'comment_body') if max_id is not None else []
+
+    if max_id is None:
+        notes.append("comment_meta-0.xml isn't downloaded yet, so the comment count is unknown; "
+                     "only the request that finds it out is counted")
+        endpoints['comment_meta'] = endpoint(1, 0, 1, DEFAULT_BYTES['comment_meta'], lj_seconds)
+        endpoints['comment_body'] = endpoint(0, 0, 1, DEFAULT_BYTES['comment_body'], lj_seconds)
+        missing_ranges = []
+    else:
+        meta_pages = math.ceil((max_id + 1) / COMMENT_META_PAGE_SIZE)
+        meta_files = list(export.find_files_by_pattern('comment_meta-*.xml', comments_xml_dir))
+        endpoints['comment_meta'] = endpoint(meta_pages, min(len(meta_starts), meta_pages), 1,
+                                             average_size(meta_files, DEFAULT_BYTES['comment_meta']), lj_seconds,
+                                             maxid=max_id)
+
+        body_pages = math.ceil((max_id + 1) / COMMENT_BODY_PAGE_SIZE)
+        missing_ranges = missing_id_ranges(max_id, body_starts, COMMENT_BODY_PAGE_SIZE)
+        missing_pages = sum(math.ceil((b - a + 1) / COMMENT_BODY_PAGE_SIZE) for a, b in missing_ranges)
+        body_files = list(export.find_files_by_pattern('comment_body-*.xml', comments_xml_dir))
+        endpoints['comment_body'] = endpoint(body_pages, body_pages - missing_pages, 1,
+                                             average_size(body_files, DEFAULT_BYTES['comment_body']), lj_seconds)
+
+    # Userpics of friends, from the journal's FOAF file
+    nicks = friend_nicks(journal)
+    pic_files = list(Path(userpics.userpic_dirs['pix']).glob('*'))
+    if nicks is None:
+        notes.append(f"No FOAF file for {journal} yet, so the friend count is unknown")
+        nicks = []
+    missing_friends = [n for n in nicks if not has_local_userpic(n)]
+    endpoints['friend_userpics'] = endpoint(
+        len(nicks), len(nicks) - len(missing_friends), 1,
+        average_size(pic_files, DEFAULT_BYTES['friend_userpics']),
+        DEFAULT_LATENCY + USERPIC_SLEEPS['friend_userpics'])
+
+    # Userpics of everyone else who commented: an FOAF file and a pic each
+    usermap_file = os.path.join(lj_user_dir, 'comments_user_map.json')
+    commenters = []
+    if os.path.isfile(usermap_file):
+        with open(usermap_file) as f:
+            commenters = sorted(set(json.load(f).values()) - set(nicks))
+    missing_commenters = [u for u in commenters if not has_local_userpic(u)]
+    endpoints['commenter_userpics'] = endpoint(
+        len(commenters), len(commenters) - len(missing_commenters), 2,
+        DEFAULT_BYTES['commenter_userpics'],
+        (DEFAULT_LATENCY * 2 + USERPIC_SLEEPS['commenter_userpics']) / 2)
+
+    plan = {
+        'journal': journal,
+        'requests_per_second': rate,
+        'endpoints': endpoints,
+        'totals': {k: sum(e[k] for e in endpoints.values()) for k in ('requests', 'bytes', 'seconds')},
+        'notes': notes,
+    }
+    plan['chunks'] = make_chunks(endpoints, missing_months, max_id, missing_ranges, missing_friends,
+                                 missing_commenters, chunk_requests)
+
+    return plan
+
+
+def make_chunks(endpoints, missing_months, max_id, missing_ranges, missing_friends, missing_commenters,
+                chunk_requests):
+    """ Splits the remaining work into pieces of about chunk_requests requests, in the order export.py does it """
+    chunks = []
+
+    def add(kind, items, requests_per_item, key):
+        step = max(1, chunk_requests // requests_per_item)
+        seconds_per_item = endpoints[kind]['seconds'] / max(endpoints[kind]['remaining'], 1)
+        for i in range(0, len(items), step):
+            part = items[i:i + step]
+            chunks.append({'kind': kind, key: part, 'requests': len(part) * requests_per_item,
+                           'seconds': len(part) * seconds_per_item})
+
+    if missing_friends:
+        chunks.append({'kind': 'friend_userpics', 'requests': endpoints['friend_userpics']['requests'],
+                       'seconds': endpoints['friend_userpics']['seconds']})
+
+    if export.POST_BACKEND == 'flat' and missing_months:
+        chunks.append({'kind': 'posts', 'months': missing_months, 'requests': endpoints['posts']['requests'],
+                       'seconds': endpoints['posts']['seconds']})
+    else:
+        add('posts', missing_months, 1, 'months')
+
+    # The usermap pages are one sequence, and needed before the comment bodies
+    if endpoints['comment_meta']['remaining']:
+        chunks.append({'kind': 'comment_meta', 'requests': endpoints['comment_meta']['requests'],
+                       'seconds': endpoints['comment_meta']['seconds']})
+
+    # Comment bodies as id ranges of up to chunk_requests pages
+    span = chunk_requests * COMMENT_BODY_PAGE_SIZE
+    seconds_per_page = endpoints['comment_body']['seconds'] / max(endpoints['comment_body']['remaining'], 1)
+    for first, last in missing_ranges:
+        for start in range(first, last + 1, span):
+            end = min(start + span - 1, last)
+            pages = math.ceil((end - start + 1) / COMMENT_BODY_PAGE_SIZE)
+            chunks.append({'kind': 'comment_body', 'start_id': start, 'end_id': end, 'requests': pages,
+                           'seconds': pages * seconds_per_page})
+
+    add('commenter_userpics', missing_commenters, 2, 'users')
+
+    for n, chunk in enumerate(chunks):
+        chunk['n'] = n
+
+    return chunks
+
+
+def run_chunk(journal, chunk, top_dir=export.DOWNLOADED_JOURNALS_DIR):
+    export_dirs = export.ensure_export_dirs(top_dir, journal, export.EXPORT_DIRS)
+    kind = chunk['kind']
+
+    if kind == 'friend_userpics':
+        userpics.get_friends_default_pics_for_user(journal, copy_dir=export_dirs['userpics'])
+    elif kind == 'posts':
+        months = export.POST_BACKEND != 'flat' and [tuple(m) for m in chunk['months']] or None
+        export.download_posts(export_dirs['posts_xml'], journal=journal, years_and_months=months)
+    elif kind == 'comment_meta':
+        export.get_users_map(export_dirs['comments_xml'], export_dirs['lj_user'], journal=journal)
+    elif kind == 'comment_body':
+        export.download_comments(export_dirs['comments_xml'], export_dirs['lj_user'], journal=journal,
+                                 start_id=chunk['start_id'], end_id=chunk['end_id'], reuse_pages=True)
+    elif kind == 'commenter_userpics':
+        userpics.resolve_userpics(chunk['users'], copy_dir=export_dirs['userpics'],
+                                  max_workers=getattr(config, 'userpic_max_workers', 2))
+    else:
+        raise ValueError(f"Unknown chunk kind '{kind}'")
+
+
+def format_bytes(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024 or unit == 'GB':
+            return f'{n:.1f} {unit}' if unit != 'B' else f'{n} B'
+        n /= 1024
+
+
+def format_seconds(s):
+    h, rest = divmod(int(s), 3600)
+    return f'{h}h {rest // 60:02d}m' if h else f'{rest // 60}m {rest % 60:02d}s'
+
+
+def print_plan(plan):
+    print(f"Export plan for {plan['journal']} at {plan['requests_per_second']} requests/second\n")
+    print(f"{'endpoint':<20} {'total':>8} {'cached':>8} {'requests':>9} {'bytes':>11} {'time':>10}")
+    for name, e in plan['endpoints'].items():
+        print(f"{name:<20} {e['total']:>8} {e['cached']:>8} {e['requests']:>9} "
+              f"{format_bytes(e['bytes']):>11} {format_seconds(e['seconds']):>10}")
+
+    t = plan['totals']
+    print(f"{'remaining':<20} {'':>8} {'':>8} {t['requests']:>9} {format_bytes(t['bytes']):>11} "
+          f"{format_seconds(t['seconds']):>10}")
+
+    for note in plan['notes']:
+        print(f"\nNote: {note}")
+
+    print(f"\n{len(plan['chunks'])} chunks")
+    for c in plan['chunks']:
+        detail = ''
+        if c['kind'] == 'posts':
+            detail = f"{c['months'][0][0]}-{c['months'][0][1]:02d} to {c['months'][-1][0]}-{c['months'][-1][1]:02d}"
+        elif c['kind'] == 'comment_body':
+            detail = f"comments {c['start_id']} to {c['end_id']}"
+        elif c['kind'] == 'commenter_userpics':
+            detail = f"{len(c['users'])} users"
+        print(f"  {c['n']:>4}  {c['kind']:<20} {detail:<30} {c['requests']:>6} requests  {format_seconds(c['seconds'])}")
+
+
+def main():
+    args = sys.argv[1:]
+    journal = args[0] if args and not args[0].startswith('--') else config.username
+    plan_file = os.path.join(export.DOWNLOADED_JOURNALS_DIR, journal, PLAN_FILE)
+
+    if '--chunk' in args:
+        with open(plan_file) as f:
+            plan = json.load(f)
+        chunk = plan['chunks'][int(args[args.index('--chunk') + 1])]
+        run_chunk(journal, chunk)
+        return
+
+    plan = make_plan(journal)
+    os.makedirs(os.path.dirname(plan_file), exist_ok=True)
+    with open(plan_file, 'w') as f:
+        f.write(json.dumps(plan, ensure_ascii=False, indent=2))
+
+    print_plan(plan)
+
+
+if __name__ == '__main__':
+    export.setup_logging()
+
+    main()
@@ -0,0 +1,137 @@
+"""
+Progress of the long parts of an export, as events rather than log lines.
+
+The exporter starts a Stage for each long step (downloading posts, downloading comments, rendering),
+with a total where one is known up front, and advances it as items are done.  Every start, advance
+and finish is handed to the listeners, which are called as listener(event, stage) with event one of
+'start', 'advance' or 'finish':
+
+    import progress
+    progress.add_listener(lambda event, stage: scheduler.report(stage.journal, stage.name, stage.done, stage.total))
+
+A stage has name, journal, done, total (None if unknown), elapsed, rate (items/second) and eta
+(seconds, None if unknown).  Listeners are called on the exporting thread, so they should be quick;
+TerminalRenderer only draws a few times a second however fast items go by.
+"""
+
+import sys
+import threading
+import time
+
+# Replaced rather than changed in place, so emit() can go through it without a lock
+listeners = ()
+listeners_lock = threading.Lock()
+
+
+def add_listener(listener):
+    global listeners
+    with listeners_lock:
+        listeners = listeners + (listener,)
+
+
+def remove_listener(listener):
+    global listeners
+    with listeners_lock:
+        listeners = tuple(l for l in listeners if l is not listener)
+
+
+def emit(event, stage):
+    for listener in listeners:
+        listener(event, stage)
+
+
+class Stage:
+    __slots__ = ('name', 'journal', 'total', 'done', 'start_time', 'end_time')
+
+    def __init__(self, name, total=None, journal=None):
+        self.name = name
+        self.journal = journal
+        self.total = total
+        self.done = 0
+        self.start_time = time.monotonic()
+        self.end_time = None
+
+    @property
+    def elapsed(self):
+        return (self.end_time or time.monotonic()) - self.start_time
+
+    @property
+    def rate(self):
+        elapsed = self.elapsed
+        return elapsed and self.done / elapsed or 0.0
+
+    @property
+    def eta(self):
+        rate = self.rate
+        if self.total is None or not rate:
+            return None
+        return max(self.total - self.done, 0) / rate
+
+    def advance(self, n=1):
+        self.done += n
+        if listeners:
+            emit('advance', self)
+
+    def finish(self):
+        self.end_time = time.monotonic()
+        emit('finish', self)
+
+
+def start(name, total=None, journal=None):
+    """ Starts and returns a Stage """
+    stage = Stage(name, total=total, journal=journal)
+    emit('start', stage)
+    return stage
+
+
+def format_duration(seconds):
+    m, s = divmod(int(seconds), 60)
+    h, m = divmod(m, 60)
+    return h and f'{h}:{m:02d}:{s:02d}' or f'{m}:{s:02d}'
+
+
+def describe(stage):
+    """ e.g. 'me comments: 41000/120000 (34%), 812.3/s, ETA 1:37' """
+    name = stage.journal and f'{stage.journal} {stage.name}' or stage.name
+
+    if stage.total:
+        done = f'{stage.done}/{stage.total} ({100 * stage.done // stage.total}%)'
+    else:
+        done = str(stage.done)
+
+    eta = stage.eta
+    timing = stage.end_time and f'in {format_duration(stage.elapsed)}' or \
+        (eta is not None and f'ETA {format_duration(eta)}' or '')
+
+    return f'{name}: {done}, {stage.rate:.1f}/s' + (timing and f', {timing}')
+
+
+class TerminalRenderer:
+    """
+    Shows stages on stream, at most every interval seconds per stage.  On a terminal the line is
+    redrawn in place; otherwise (e.g. redirected to a file) a line is written each time.
+    """
+
+    def __init__(self, stream=sys.stderr, interval=0.5):
+        self.stream = stream
+        self.tty = stream.isatty()
+        self.interval = interval if self.tty else max(interval, 10)
+        self.last_drawn = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, event, stage):
+        now = time.monotonic()
+        if event == 'advance' and now - self.last_drawn.get(id(stage), 0) < self.interval:
+            return
+
+        with self.lock:
+            self.last_drawn[id(stage)] = now
+            if event == 'finish':
+                del self.last_drawn[id(stage)]
+
+            if self.tty:
+                end = event == 'finish' and '\n' or ''
+                self.stream.write(f'\r{describe(stage)}\x1b[K{end}')
+            else:
+                self.stream.write(describe(stage) + '\n')
+            self.stream.flush()
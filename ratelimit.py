@@ -0,0 +1,41 @@
+import threading
+import time
+
+import ljconfig as config
+
+
+class RateLimiter:
+    """Spaces out calls so that no more than `rate` happen per second, across all threads
+
+    A rate of 0 or None disables limiting.
+    """
+
+    def __init__(self, rate=1.0):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        if not self.interval:
+            return
+
+        # Reserve the next slot while holding the lock, then sleep outside it
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_time)
+            self.next_time = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+    def __enter__(self):
+        self.wait()
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+# Shared by every request made to LJ: the export endpoints, and FOAF files and userpics, from every
+# thread of every concurrent bulk export
+LJ_RATE_LIMIT = RateLimiter(getattr(config, 'requests_per_second', 1))
@@ -0,0 +1,105 @@
+import gzip
+import io
+import os
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Suffix appended to a raw download's filename for each supported compression
+COMPRESSION_SUFFIXES = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+
+def raw_path(path, compression=None):
+    """ The filename a raw download is stored under for the given compression (None for plain files) """
+    path = Path(path)
+    if not compression:
+        return path
+
+    if compression not in COMPRESSION_SUFFIXES:
+        raise ValueError(f"Unknown raw compression '{compression}', use one of {', '.join(COMPRESSION_SUFFIXES)}")
+
+    return path.with_name(path.name + COMPRESSION_SUFFIXES[compression])
+
+
+def find_raw(path):
+    """ Returns the stored file for a raw download, whichever way it was compressed, or None """
+    for compression in [None, *COMPRESSION_SUFFIXES]:
+        candidate = raw_path(path, compression)
+        if candidate.is_file():
+            return candidate
+
+    return None
+
+
+def raw_patterns(filepat):
+    """ fnmatch patterns matching filepat as well as its compressed forms """
+    return [filepat] + [filepat + suffix for suffix in COMPRESSION_SUFFIXES.values()]
+
+
+def open_raw(path):
+    """ Opens a stored raw download for binary reading, decompressing on the fly """
+    path = Path(path)
+
+    if path.suffix == COMPRESSION_SUFFIXES['gzip']:
+        return gzip.open(path, 'rb')
+
+    if path.suffix == COMPRESSION_SUFFIXES['zstd']:
+        ensure_zstandard()
+        f = open(path, 'rb')
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f, closefd=True))
+
+    return open(path, 'rb')
+
+
+def read_raw(path):
+    with open_raw(path) as f:
+        return f.read()
+
+
+def write_raw(path, data, compression=None):
+    """
+    Stores a raw download, compressed if asked, and returns the filename it was written to.
+    Copies of the same file stored with other compressions are removed so readers never see both.
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+
+    save_file = raw_path(path, compression)
+
+    # Written alongside and renamed into place, so an interrupted write never leaves a truncated file
+    tmp_file = save_file.with_name(save_file.name + '.tmp')
+    try:
+        if compression == 'gzip':
+            with gzip.open(tmp_file, 'wb') as f:
+                f.write(data)
+        elif compression == 'zstd':
+            ensure_zstandard()
+            with open(tmp_file, 'wb') as f:
+                f.write(zstandard.ZstdCompressor(level=10).compress(data))
+        else:
+            with open(tmp_file, 'wb') as f:
+                f.write(data)
+    except BaseException:
+        if tmp_file.is_file():
+            os.remove(tmp_file)
+        raise
+
+    os.replace(tmp_file, save_file)
+
+    for other in [None, *COMPRESSION_SUFFIXES]:
+        other_file = raw_path(path, other)
+        if other_file != save_file and other_file.is_file():
+            os.remove(other_file)
+
+    return save_file
+
+
+def ensure_zstandard():
+    if zstandard is None:
+        raise RuntimeError("zstd compression needs the zstandard package: pip install zstandard")
@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Full-text search over an exported journal, built by export.combine.
+
+Posts and their comments go into an SQLite FTS5 table.  Each post's content digest is stored too,
+so a rerun only reindexes posts whose text or comments changed.
+
+    python search.py exported_journals/<username> "some words"
+"""
+
+import html
+import json
+import os
+import re
+import sqlite3
+import sys
+from hashlib import sha1
+
+SEARCH_DB_FILE = 'search.sqlite'
+
+TAGS = re.compile(r'<[^>]+>')
+WORDS = re.compile(r'\w+')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS indexed_posts (
+    post_id TEXT PRIMARY KEY,
+    digest TEXT NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS entries USING fts5(
+    post_id UNINDEXED,
+    comment_id UNINDEXED,
+    subject,
+    body,
+    author,
+    date,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+
+def strip_tags(text):
+    return html.unescape(TAGS.sub(' ', text or ''))
+
+
+class SearchIndex:
+    def __init__(self, db_file):
+        self.db = sqlite3.connect(db_file)
+        self.db.executescript(SCHEMA)
+        self.changed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def update_post(self, post, thread=None, author=None):
+        """ (Re)indexes a post and its comment thread, unless it's unchanged since the last run """
+        rows = [(post['id'], None, post.get('subject') or '', strip_tags(post.get('body')), author or '',
+                 post.get('date') or '')]
+
+        if thread is not None:
+            for comment in thread.comments:
+                if comment.deleted:
+                    continue
+                rows.append((post['id'], comment.id, comment.subject or '', strip_tags(comment.body),
+                             comment.author or '', comment.date or ''))
+
+        digest = sha1(json.dumps(rows, ensure_ascii=False).encode('utf-8')).hexdigest()
+        stored = self.db.execute('SELECT digest FROM indexed_posts WHERE post_id = ?', (post['id'],)).fetchone()
+        if stored and stored[0] == digest:
+            return False
+
+        self.db.execute('DELETE FROM entries WHERE post_id = ?', (post['id'],))
+        self.db.executemany('INSERT INTO entries (post_id, comment_id, subject, body, author, date) '
+                            'VALUES (?, ?, ?, ?, ?, ?)', rows)
+        self.db.execute('INSERT OR REPLACE INTO indexed_posts (post_id, digest) VALUES (?, ?)', (post['id'], digest))
+        self.changed += 1
+        return True
+
+    def prune(self, post_ids):
+        """ Drops posts that are no longer part of the export """
+        keep = set(post_ids)
+        stale = [row[0] for row in self.db.execute('SELECT post_id FROM indexed_posts') if row[0] not in keep]
+
+        for post_id in stale:
+            self.db.execute('DELETE FROM entries WHERE post_id = ?', (post_id,))
+            self.db.execute('DELETE FROM indexed_posts WHERE post_id = ?', (post_id,))
+
+        self.changed += len(stale)
+        return len(stale)
+
+    def query(self, text, limit=20):
+        """ Best matches first, as dicts with post_id, comment_id (None for the post itself), author, date, snippet """
+        # Quote each word so user input can't be taken as FTS5 query syntax
+        match = ' '.join('"{0}"'.format(w) for w in WORDS.findall(text))
+        if not match:
+            return []
+
+        cursor = self.db.execute(
+            "SELECT post_id, comment_id, subject, author, date, snippet(entries, 3, '[', ']', '...', 12) "
+            "FROM entries WHERE entries MATCH ? ORDER BY rank LIMIT ?", (match, limit))
+
+        keys = ('post_id', 'comment_id', 'subject', 'author', 'date', 'snippet')
+        return [dict(zip(keys, row)) for row in cursor]
+
+    def write_json_shards(self, shard_dir, prefix_length=2):
+        """
+        Writes a static inverted index a web page can search without a server.
+
+        Terms are split into shards by their first prefix_length characters: shard_dir/<prefix>.json maps
+        each term to the ids of the posts it occurs in.  shard_dir/manifest.json lists the shards.
+        """
+        shards = {}
+        for post_id, subject, body, author in self.db.execute('SELECT post_id, subject, body, author FROM entries'):
+            for term in set(WORDS.findall(' '.join((subject, body, author)).lower())):
+                shard = shards.setdefault(term[:prefix_length], {})
+                shard.setdefault(term, set()).add(post_id)
+
+        os.makedirs(shard_dir, exist_ok=True)
+        for prefix, terms in shards.items():
+            with open(os.path.join(shard_dir, f'{prefix}.json'), 'w') as f:
+                json.dump({t: sorted(ids) for t, ids in terms.items()}, f, ensure_ascii=False, separators=(',', ':'))
+
+        with open(os.path.join(shard_dir, 'manifest.json'), 'w') as f:
+            json.dump({'prefix_length': prefix_length, 'shards': sorted(shards)}, f)
+
+        return len(shards)
+
+
+def main():
+    if len(sys.argv) < 3:
+        print(f"usage: {sys.argv[0]} exported_journals/<username> <words>")
+        sys.exit(1)
+
+    db_file = os.path.join(sys.argv[1], SEARCH_DB_FILE)
+    if not os.path.isfile(db_file):
+        print(f"No search index at {db_file}, run export.py first")
+        sys.exit(1)
+
+    with SearchIndex(db_file) as index:
+        for hit in index.query(' '.join(sys.argv[2:])):
+            where = hit['comment_id'] and f"comment {hit['comment_id']} on post" or 'post'
+            print(f"{hit['date']}  {where} {hit['post_id']}  {hit['author']}  {hit['subject']}")
+            print(f"    {hit['snippet']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import os
+import re
+import sys
+
+import html2text
+import markdown
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bodytext
+
+# The rewrites export.py made one regex pass at a time before bodytext, kept here as the reference
+OLD_TAG = re.compile(r'\[!\[(.*?)\]\(http:/\/utx.ambience.ru\/img\/.*?\)\]\(.*?\)')
+OLD_USER = re.compile(r'<lj user="?(.*?)"?>')
+OLD_TAGLESS_NEWLINES = re.compile('(?<!>)\n')
+OLD_NEWLINES = re.compile(r'(\s*\n){3,}')
+
+BODIES = [
+    'Plain text',
+    'Line one\nline two\n\n\n\nafter a gap',
+    'Hello <lj user="bob">, and <lj user=al> too',
+    '<lj user="bob">\nstarts a line',
+    '<p>Nested <b>bold <i>and <a href="http://example.com/?a=1&amp;b=2">a link</a></i></b></p>\nnext',
+    '<ul>\n<li>one</li>\n<li>two <lj user="cy"></li>\n</ul>\ntail',
+    'Look: <img src="http://example.com/pic.jpg" alt="pic">\n<a href="http://example.com/big.jpg">'
+    '<img src="http://example.com/small.jpg"></a>',
+    '[![news](http://utx.ambience.ru/img/x.gif)](http://u)\n[![life](http://utx.ambience.ru/img/y.gif)](http://v)'
+    '\ntext',
+    '<blockquote>quoted\n<lj user="bob"> said</blockquote>\n\n\n\n\nend',
+]
+
+
+def old_html(body):
+    return OLD_TAGLESS_NEWLINES.sub('<br>\n', OLD_USER.sub(r'\1', body))
+
+
+def old_markdown(body):
+    h = html2text.HTML2Text()
+    h.body_width = 0
+    h.unicode_snob = True
+    md = OLD_NEWLINES.sub('\n\n', h.handle(OLD_TAGLESS_NEWLINES.sub('<br>', OLD_USER.sub(r'\1', body))))
+    return OLD_TAG.sub('', md).strip(), OLD_TAG.findall(md)
+
+
+def new_markdown(body_html):
+    h = html2text.HTML2Text()
+    h.body_width = 0
+    h.unicode_snob = True
+    md, tags = bodytext.clean_markdown(h.handle(body_html))
+    return md.strip(), tags
+
+
+def test_bodies_match_previous_transform():
+    for body in BODIES:
+        result = bodytext.transform(body)
+
+        assert result.text == OLD_USER.sub(r'\1', body)
+        assert result.html == old_html(body)
+        assert markdown.markdown(result.html) == markdown.markdown(old_html(body))
+        assert new_markdown(result.md_html) == old_markdown(body)
+
+
+def test_utx_tags():
+    md, tags = new_markdown(bodytext.transform(BODIES[7]).md_html)
+
+    assert tags == ['news', 'life']
+    assert md == 'text'
+
+
+def test_cut_and_embed():
+    result = bodytext.transform('Intro <lj-cut text="More">\nhidden</lj-cut>\n<lj-embed id="3" />\n'
+                                '<lj-embed id="4"><iframe src="http://v"></iframe></lj-embed>')
+
+    assert result.text == ('Intro <lj-cut text="More">\nhidden</lj-cut>\n<lj-embed id="3" />\n'
+                           '<lj-embed id="4"><iframe src="http://v"></iframe></lj-embed>')
+    assert result.html == ('Intro \nhidden\n<div class=lj-embed data-embed="3"></div>\n'
+                           '<iframe src="http://v"></iframe>')
+
+
+def test_empty_bodies():
+    assert bodytext.transform('').html == ''
+    assert bodytext.transform(None).text is None
@@ -0,0 +1,61 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PAGE = '''<?xml version="1.0" encoding="utf-8"?><livejournal><comments>
+{0}
+</comments></livejournal>'''
+
+COMMENT = '<comment id="{0}" jitemid="1" posterid="10"><date>2010-01-05T11:00:00Z</date><body>c{0}</body></comment>'
+
+
+def test_overlapping_pages_give_each_comment_once(tmp_path, monkeypatch):
+    # export creates its working directories where it runs
+    monkeypatch.chdir(tmp_path)
+    import export
+    import jsonstream
+
+    export_dirs = export.ensure_export_dirs(str(tmp_path / 'exported_journals'), 'me', export.EXPORT_DIRS)
+    with open(os.path.join(export_dirs['lj_user'], 'comments_user_map.json'), 'w') as f:
+        json.dump({'10': 'bob'}, f)
+
+    # The page at 0 ran past 5, where the next chunk's page starts
+    for start, ids in ((0, range(1, 9)), (5, range(5, 12))):
+        with open(os.path.join(export_dirs['comments_xml'], f'comment_body-{start}.xml'), 'w') as f:
+            f.write(PAGE.format('\n'.join(COMMENT.format(i) for i in ids)))
+
+    export.create_comments_json_all_file(export_dirs['comments_xml'], export_dirs['lj_user'])
+
+    ids = [c['id'] for c in jsonstream.read_records(
+        jsonstream.records_filename(export_dirs['lj_user'], 'all_comments', export.JSON_FORMAT))]
+    assert sorted(ids) == list(range(1, 12))
+
+
+class FakeResponse:
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+
+def test_error_pages_are_not_stored_or_reused(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    import export
+
+    responses = [FakeResponse(503, b'<html>busy</html>'), FakeResponse(200, b'<html><body>login</body></html>'),
+                 FakeResponse(200, PAGE.format(COMMENT.format(1)).encode('utf-8'))]
+    monkeypatch.setattr(export.requests, 'get', lambda *args, **kwargs: responses.pop(0))
+    monkeypatch.setattr(export.LJ_RATE_LIMIT, 'wait', lambda: None)
+    monkeypatch.setattr(export, 'get_cookies', lambda: {})
+
+    # A page from an earlier run is fetched again unless reuse is asked for
+    with open(tmp_path / 'comment_body-1.xml', 'w') as f:
+        f.write(PAGE.format(COMMENT.format(2)))
+
+    max_id, comments = export.get_more_comments(1, {'10': 'bob'}, str(tmp_path))
+    assert [c.id for c in comments] == [1]
+    assert not responses
+
+    max_id, comments = export.get_more_comments(1, {'10': 'bob'}, str(tmp_path), reuse=True)
+    assert [c.id for c in comments] == [1]
@@ -0,0 +1,52 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from comments import Comment, CommentThread
+
+DEPTH = 3000
+
+
+def reply_chain(depth, jitemid=1):
+    return [Comment(id=i, jitemid=jitemid, parentid=i - 1 if i > 1 else None, posterid=10,
+                    date='2010-01-05T11:00:00Z', epoch=1262689200, subject=None, body=f'reply {i}',
+                    state=None, author='bob')
+            for i in range(1, depth + 1)]
+
+
+def test_nested_json_matches_json_dumps():
+    comments = reply_chain(30) + [Comment(id=100, jitemid=1, parentid=3, posterid=11, date=None, epoch=None,
+                                          subject='"quoted"\nline', body=None, state='D', author=None),
+                                  Comment(id=101, jitemid=1, parentid=999, posterid=None, date=None, epoch=None,
+                                          subject=None, body='orphan', state=None, author=None)]
+    thread = CommentThread(comments)
+
+    for indent in (None, 0, 2):
+        assert thread.to_nested_json(indent=indent) == json.dumps(thread.to_nested(), ensure_ascii=False,
+                                                                  indent=indent)
+
+
+def test_combine_deep_thread(tmp_path, monkeypatch):
+    # export creates its working directories where it runs
+    monkeypatch.chdir(tmp_path)
+    import export
+
+    export_dirs = export.ensure_export_dirs(str(tmp_path / 'exported_journals'), 'me', export.EXPORT_DIRS)
+    post = {'id': '256', 'logtime': '2010-01-05 10:00:00', 'subject': 'Deep', 'body': 'Hello', 'security': 'public',
+            'date': '2010-01-05 10:00:00', 'epoch': 1262685600, 'allowmask': '0', 'current_music': None,
+            'current_mood': None}
+
+    export.combine([post], reply_chain(DEPTH), export_dirs, slugs={}, userpic_files={'bob': 'bob.png'})
+
+    with open(os.path.join(export_dirs['posts_json'], '256.json')) as f:
+        text = f.read()
+
+    # json.loads recurses too, so check the nesting without it
+    assert text.count('"children": [') == DEPTH
+    assert text.count('"id": ') == DEPTH + 2
+    assert f'"body": "reply {DEPTH}"' in text
+
+    with open(os.path.join(export_dirs['posts_html'], '2010', '01', '256.html')) as f:
+        assert f.read().count('<li') == DEPTH
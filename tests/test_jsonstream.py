@@ -0,0 +1,25 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jsonstream
+
+
+def test_failed_write_keeps_previous_file(tmp_path):
+    filename = str(tmp_path / 'all_posts.json')
+    jsonstream.write_records(filename, [{'id': 1}])
+
+    def records():
+        yield {'id': 2}
+        raise ValueError("bad XML")
+
+    with pytest.raises(ValueError):
+        jsonstream.write_records(filename, records())
+
+    with open(filename) as f:
+        assert json.load(f) == [{'id': 1}]
+    assert os.listdir(tmp_path) == ['all_posts.json']
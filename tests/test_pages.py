@@ -0,0 +1,59 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import outwriter
+from comments import Comment, CommentThread
+from pages import SiteAggregator, tag_slugs
+
+POST = {'id': '256', 'subject': 'Hello', 'date': '2010-01-05 10:00:00'}
+
+
+def test_replies_under_deleted_comments_not_counted():
+    thread = CommentThread([Comment(id=1, jitemid=1, author='bob'),
+                            Comment(id=2, jitemid=1, state='D'),
+                            Comment(id=3, jitemid=1, parentid=2, author='al'),
+                            Comment(id=4, jitemid=1, parentid=3, author='cy')])
+    site = SiteAggregator()
+    site.add_post(POST, os.path.join('2010', '01'), 1262685600, thread)
+
+    assert site.posts[0].comments == 1
+    assert site.commenters == {'bob': 1}
+
+
+def test_tag_slugs_are_unique():
+    slugs = tag_slugs(['C', 'C++', 'c', 'index', 'c-2'])
+
+    assert len(set(slugs.values())) == 5
+    assert slugs['C'] == 'c'
+    assert slugs['index'] != 'index'
+
+
+def test_tag_pages(tmp_path):
+    site = SiteAggregator()
+    site.add_post(POST, os.path.join('2010', '01'), 1262685600, tags=['C', 'C++'])
+
+    with outwriter.OutputWriter(str(tmp_path)) as writer:
+        site.write_pages(writer)
+
+    tags_dir = tmp_path / 'posts_html' / 'tags'
+    index = (tags_dir / 'index.html').read_text()
+    for page in ('c.html', 'c-2.html'):
+        assert (tags_dir / page).is_file()
+        assert f'href="{page}"' in index
+
+
+def test_posts_listed_by_filing_time(tmp_path):
+    site = SiteAggregator()
+    site.add_post({'id': '256', 'subject': 'Old', 'date': '2010-01-05 10:00:00'}, os.path.join('2010', '01'),
+                  1262685600)
+    # An unreadable eventtime, filed by its logtime instead
+    site.add_post({'id': '512', 'subject': 'Bogus', 'date': 'bogus'}, os.path.join('2011', '03'), 1299319200)
+
+    with outwriter.OutputWriter(str(tmp_path)) as writer:
+        site.write_pages(writer)
+
+    index = (tmp_path / 'posts_html' / 'index.html').read_text()
+    assert 'bogus' not in index
+    assert index.index('2011-03-05') < index.index('2010-01-05')
@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import timestamps
+
+
+def test_year_month():
+    assert timestamps.year_month(timestamps.parse('2010-01-05 10:00:00')) == (2010, 1)
+    assert timestamps.year_month(timestamps.parse('not a date')) is None
+
+
+def test_month_range():
+    assert timestamps.month_range('2010/11/01', '2011/02/01') == [(2010, 11), (2010, 12), (2011, 1), (2011, 2)]
+
+    with pytest.raises(ValueError):
+        timestamps.month_range('2010/11/01', 'someday')
@@ -0,0 +1,44 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+META_PAGE = '''<?xml version="1.0" encoding="utf-8"?><livejournal><maxid>25</maxid>{nextid}
+<usermaps><usermap id="{0}" user="user{0}"/></usermaps></livejournal>'''
+
+
+def write_meta_pages(comments_xml_dir):
+    for start, next_id in ((0, 10), (10, 20), (20, None)):
+        with open(os.path.join(comments_xml_dir, f'comment_meta-{start}.xml'), 'w') as f:
+            f.write(META_PAGE.format(start + 1, nextid=next_id and f'<nextid>{next_id}</nextid>' or ''))
+
+
+def test_interrupted_usermap_is_resumed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    import export
+
+    export_dirs = export.ensure_export_dirs(str(tmp_path / 'exported_journals'), 'me', export.EXPORT_DIRS)
+    comments_xml_dir, lj_user_dir = export_dirs['comments_xml'], export_dirs['lj_user']
+    write_meta_pages(comments_xml_dir)
+
+    # Interrupted on the last page, after a checkpoint at every page
+    read_page = export.get_comment_metadata_page
+
+    def failing_page(comments_xml_dir, start_id=0, **kwargs):
+        if start_id == 20:
+            raise KeyboardInterrupt
+        return read_page(comments_xml_dir, start_id, **kwargs)
+
+    monkeypatch.setattr(export, 'get_comment_metadata_page', failing_page)
+    with pytest.raises(KeyboardInterrupt):
+        export.build_users_map(comments_xml_dir, lj_user_dir, checkpoint_pages=1)
+    monkeypatch.setattr(export, 'get_comment_metadata_page', read_page)
+
+    assert export.read_users_map_state(lj_user_dir)['complete'] is False
+
+    users = export.get_users_map(comments_xml_dir, lj_user_dir)
+    assert users == {'1': 'user1', '11': 'user11', '21': 'user21'}
+    assert export.read_users_map_state(lj_user_dir)['complete'] is True
@@ -0,0 +1,81 @@
+"""
+Date handling for LJ timestamps, without arrow.
+
+LJ dates come in a few fixed layouts ('2010-01-05 10:00:00' for posts, '2010-01-05T11:00:00Z' for
+comments, '2003/07/01' in ljconfig), so they are parsed by slicing rather than by a general parser.
+Times are treated as UTC: comment times are UTC, and post times are the journal's own clock time,
+which is kept as-is.
+"""
+
+import time
+from calendar import timegm
+from functools import lru_cache
+
+MONTH_NAMES = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September',
+               'October', 'November', 'December']
+
+SECONDS_PER_DAY = 86400
+
+
+@lru_cache(maxsize=65536)
+def days_since_epoch(year, month, day):
+    return timegm((year, month, day, 0, 0, 0)) // SECONDS_PER_DAY
+
+
+def parse(date):
+    """ Seconds since the epoch for a 'YYYY-MM-DD[ T]HH:MM:SS[Z]' or 'YYYY/MM/DD' date, None if it isn't one """
+    try:
+        days = days_since_epoch(int(date[0:4]), int(date[5:7]), int(date[8:10]))
+        if len(date) < 19:
+            return days * SECONDS_PER_DAY
+
+        return days * SECONDS_PER_DAY + int(date[11:13]) * 3600 + int(date[14:16]) * 60 + int(date[17:19])
+    except (TypeError, ValueError):
+        return None
+
+
+def format_sync_time(epoch):
+    """ e.g. 2010-01-05 11:00:00, as syncitems gives and takes times """
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(epoch))
+
+
+def iso(epoch):
+    """ e.g. 2010-01-05T11:00:00Z """
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(epoch))
+
+
+@lru_cache(maxsize=16384)
+def display_day(days):
+    t = time.gmtime(days * SECONDS_PER_DAY)
+    return f'{MONTH_NAMES[t.tm_mon - 1]} {t.tm_mday} {t.tm_year}'
+
+
+def display(epoch):
+    """ e.g. 'January 5 2010, 11:00:00', as shown on comments.  The date part is cached per day. """
+    days, seconds = divmod(epoch, SECONDS_PER_DAY)
+    return f'{display_day(days)}, {seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+
+
+def year_month(epoch):
+    """ (year, month), None if epoch is None (time.gmtime would take that as now) """
+    if epoch is None:
+        return None
+
+    t = time.gmtime(epoch)
+    return t.tm_year, t.tm_mon
+
+
+def month_range(start_date, end_date):
+    """ [(year, month), ...] for every month from start_date's to end_date's, inclusive """
+    start, end = year_month(parse(start_date)), year_month(parse(end_date))
+    if start is None or end is None:
+        raise ValueError(f"Can't read the date range {start_date!r} to {end_date!r}, use YYYY/MM/DD")
+
+    year, month = start
+
+    months = []
+    while (year, month) <= end:
+        months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+    return months
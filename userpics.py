@@ -1,10 +1,17 @@
-import requests
 import os
+import httpcache
 from pathlib import Path
 import time
 from lxml import etree
 import json
 import shutil
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from types import MappingProxyType
+
+from ratelimit import LJ_RATE_LIMIT
 
 BASE_URL = ".livejournal.com/data/foaf.rdf"
 
@@ -19,6 +26,7 @@ MIME_EXTENSIONS = {
 
 USERPIC_WORKING_DIR = "userpics"
 USERPIC_METADATA_FILE = Path(USERPIC_WORKING_DIR, "userpics_metadata.json")
+HTTP_CACHE_DIR = Path(USERPIC_WORKING_DIR, "http_cache")
 
 INITIAL_USERPIC_METADATA = {
     'anonymous': {
@@ -35,7 +43,8 @@ def main():
     get_friends_default_pics_for_user(lj_user)
 
 
-def get_friends_default_pics_for_user(username, copy_dir=None):
+def get_friends_default_pics_for_user(username, copy_dir=None, refresh=False):
+    """ With refresh, the FOAF file and every pic are revalidated with the server, mostly getting cheap 304s """
     rv = {
         "status": "ok"
     }
@@ -44,7 +53,7 @@ def get_friends_default_pics_for_user(username, copy_dir=None):
     rdf_dir = userpic_dirs['rdfs']
 
     # Get the user FOAF rdf file
-    user_rdf_file = ensure_rdf_for_user(username, rdf_dir)
+    user_rdf_file = ensure_rdf_for_user(username, rdf_dir, refresh=refresh)
     if not user_rdf_file:
         rv = {
             "status": "error",
@@ -56,7 +65,7 @@ def get_friends_default_pics_for_user(username, copy_dir=None):
     pix_urls = get_userpic_urls_from_rdf(user_rdf_file)
 
     for username, pic_url in pix_urls.items():
-        _ = get_userpic(username, userpix_dir, url=pic_url, copy_dir=copy_dir)
+        _ = get_userpic(username, userpix_dir, url=pic_url, copy_dir=copy_dir, force_download=refresh)
 
     return rv
 
@@ -120,7 +129,7 @@ def get_userpic_urls_from_rdf(rdf_file, username=None):
 
 
 # --------------------------------------------------------------------------------------------------------------------
-def ensure_rdf_for_user(username, rdf_dir):
+def ensure_rdf_for_user(username, rdf_dir, refresh=False):
     rv = {
         "username": username,
         "rdf_file": username + ".rdf"
@@ -128,11 +137,13 @@ def ensure_rdf_for_user(username, rdf_dir):
 
     user_rdf_file = Path(rdf_dir, username + ".rdf")
 
-    if not user_rdf_file.is_file():
-        user_rdf_file = download_rdf(username, rdf_dir)
-        if user_rdf_file:
-            time.sleep(1)  # play nice and sleep for two seconds
-        else:
+    if not user_rdf_file.is_file() or refresh:
+        # A failed refresh keeps the file from an earlier run, if there is one
+        downloaded = download_rdf(username, rdf_dir)
+        if downloaded:
+            user_rdf_file = downloaded
+        elif not user_rdf_file.is_file():
+            user_rdf_file = None
             rv['rdf_file'] = "missing"
 
     update_metadata(rv)
@@ -143,10 +154,14 @@ def ensure_rdf_for_user(username, rdf_dir):
 def download_rdf(username, download_dir):
     save_file = Path(download_dir, username + ".rdf")
 
-    r = requests.get(f'http://{username}{BASE_URL}')
-    if r.status_code == requests.codes.ok:
-        with open(save_file, 'wb') as f:
-            f.write(r.content)
+    LJ_RATE_LIMIT.wait()
+    r = httpcache.get(f'http://{username}{BASE_URL}', HTTP_CACHE_DIR, revalidate=True, body_file=save_file)
+    if r.ok:
+        if not (r.not_modified and save_file.is_file()):
+            with open(save_file, 'wb') as f:
+                f.write(r.content)
+
+        time.sleep(1)  # play nice and sleep for a second
 
         return save_file
 
@@ -155,6 +170,13 @@ def download_rdf(username, download_dir):
 
 
 def get_userpic(username, pix_dir=None, url=None, download=True, force_download=False, copy_dir=None):
+    # Concurrent exports share the userpic cache, so only one of them fetches a given user at a time
+    with user_lock(username):
+        return _get_userpic(username, pix_dir=pix_dir, url=url, download=download,
+                            force_download=force_download, copy_dir=copy_dir)
+
+
+def _get_userpic(username, pix_dir=None, url=None, download=True, force_download=False, copy_dir=None):
     rv = {
         'username': username,
         'status': None,
@@ -200,7 +222,7 @@ def get_userpic(username, pix_dir=None, url=None, download=True, force_download=
             rdf_dir = userpic_dirs['rdfs']
 
             # Get the user FOAF rdf file
-            user_rdf_file = ensure_rdf_for_user(username, rdf_dir)
+            user_rdf_file = ensure_rdf_for_user(username, rdf_dir, refresh=force_download)
             if not user_rdf_file:
                 rv = {**rv, **{
                     "status": "error",
@@ -221,9 +243,6 @@ def get_userpic(username, pix_dir=None, url=None, download=True, force_download=
                 # Update metadata file for this user
                 update_metadata(rv)
 
-            # this returns the last value, which isn't quite right but is ok
-            return rv
-
         else:
             rv = download_userpic(username, url, pix_dir)
 
@@ -233,8 +252,8 @@ def get_userpic(username, pix_dir=None, url=None, download=True, force_download=
         orig_pic_file = Path(pix_dir, rv['filename'])
         to_pic_file = Path(copy_dir, rv['filename'])
 
-        # don't copy pics if they're already there
-        if not to_pic_file.is_file():
+        # don't copy pics if they're already there, unless the pic was just downloaded again
+        if not to_pic_file.is_file() or rv['state'] == 'downloaded':
 
             # ensure there's both a source file and a destination directory, then copy
             if orig_pic_file.is_file() and Path(copy_dir).is_dir():
@@ -243,6 +262,19 @@ def get_userpic(username, pix_dir=None, url=None, download=True, force_download=
     return rv
 
 
+def resolve_userpics(usernames, copy_dir=None, max_workers=2):
+    """
+    Makes sure every user in usernames has a pic, downloading the missing ones, and returns a
+    read-only username -> filename map for rendering.  The metadata file is written once at the end.
+    """
+    usernames = sorted(set(usernames))
+
+    with batched_metadata(), ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        results = list(executor.map(lambda u: get_userpic(u, copy_dir=copy_dir), usernames))
+
+    return MappingProxyType({u: r.get('filename') or DEFAULT_USERPIC_FILE for u, r in zip(usernames, results)})
+
+
 def download_userpic(username, url, download_dir):
     rv = {
         'username': username,
@@ -251,18 +283,27 @@ def download_userpic(username, url, download_dir):
         'state': None
     }
 
-    r = requests.get(url)
-    if r.status_code == requests.codes.ok:
+    # Revalidates against the pic already downloaded, so an unchanged pic is a 304 rather than a full download
+    candidates = [Path(download_dir, username + ext) for ext in MIME_EXTENSIONS.values()]
+    pic_file = next((c for c in candidates if c.is_file()), candidates[0])
+
+    LJ_RATE_LIMIT.wait()
+    r = httpcache.get(url, HTTP_CACHE_DIR, revalidate=True, body_file=pic_file)
+    if r.ok:
         content_type = r.headers['content-type']
         download_file = Path(download_dir, username + MIME_EXTENSIONS[content_type])
-        with open(download_file, 'wb') as f:
-            f.write(r.content)
+
+        if r.not_modified and download_file.is_file():
+            rv['state'] = 'local'
+        else:
+            with open(download_file, 'wb') as f:
+                f.write(r.content)
+            rv['state'] = 'downloaded'
 
         time.sleep(1)  # avoids throttling
 
         rv['status'] = 'ok'
-        rv['filename'] = str(download_file)
-        rv['state'] = 'downloaded'
+        rv['filename'] = download_file.name
 
     else:
         rv['status'] = 'error'
@@ -304,17 +345,46 @@ def read_metadata(filepath=USERPIC_METADATA_FILE):
 
 def update_metadata(userdata, metadata_file=USERPIC_METADATA_FILE):
     user_to_update = userdata['username']
-    existing_userdata = userpics_meta.get(user_to_update, {})
 
-    merged_data = {**existing_userdata, **userdata}
-    userpics_meta[user_to_update] = merged_data
+    with metadata_lock:
+        existing_userdata = userpics_meta.get(user_to_update, {})
+
+        merged_data = {**existing_userdata, **userdata}
+        userpics_meta[user_to_update] = merged_data
 
-    with open(metadata_file, 'w') as f:
-        f.write(json.dumps(userpics_meta, ensure_ascii=False, indent=2))
+        if not metadata_batches:
+            save_metadata(metadata_file)
 
     return userpics_meta
 
 
+def save_metadata(metadata_file=USERPIC_METADATA_FILE):
+    with metadata_lock:
+        with open(metadata_file, 'w') as f:
+            f.write(json.dumps(userpics_meta, ensure_ascii=False, indent=2))
+
+
+@contextmanager
+def batched_metadata(metadata_file=USERPIC_METADATA_FILE):
+    """ Holds back metadata file writes inside the block, and writes the file once when it ends """
+    global metadata_batches
+
+    with metadata_lock:
+        metadata_batches += 1
+    try:
+        yield
+    finally:
+        with metadata_lock:
+            metadata_batches -= 1
+            if not metadata_batches:
+                save_metadata(metadata_file)
+
+
+def user_lock(username):
+    with metadata_lock:
+        return user_locks[username]
+
+
 def ensure_userpic_dirs(top_dir):
     export_dirs = {
         "rdfs": os.path.join(top_dir, 'rdfs'),
@@ -330,6 +400,9 @@ def ensure_userpic_dirs(top_dir):
 # -----
 userpic_dirs = ensure_userpic_dirs(USERPIC_WORKING_DIR)
 userpics_meta = read_metadata()
+metadata_lock = threading.RLock()
+user_locks = defaultdict(threading.Lock)
+metadata_batches = 0
 
 if __name__ == '__main__':
     main()